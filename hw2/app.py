@@ -1,65 +1,289 @@
+import functools
+import gzip
+import os
+import threading
+import time
+import traceback
+
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify
 
+import pipeline
+import utils
+from batching import MicroBatcher
+from metrics import Metrics, SlowRequestProfiler
+from prediction_cache import PredictionCache
 from stud.implementation import build_model_34, build_model_234, build_model_1234
 
 app = Flask(__name__)
-model_34 = build_model_34('cpu')
-
-try:
-    model_234 = build_model_234('cpu')
-except:
-    model_234 = None
-
-try:
-    model_1234 = build_model_1234('cpu')
-except:
-    model_1234 = None
-
-
-def prepare_data(data):
-    data_34 = data
-    data_234 = {
-        'words': data['words'],
-        'lemmas': data['lemmas'],
-        'pos_tags': data['pos_tags'],
-        'dependency_heads': data['dependency_heads'],
-        'dependency_relations': data['dependency_relations'],
-        'predicates': [1 if p != '_' else 0 for p in data['predicates']],
-    }
-    data_1234 = {
-        'words': data['words'],
-        'lemmas': data['lemmas'],
-        'pos_tags': data['pos_tags'],
-        'dependency_heads': data['dependency_heads'],
-        'dependency_relations': data['dependency_relations'],
-    }
-
-    return data_34, data_234, data_1234
+# compact responses smaller than this are not worth compressing
+GZIP_MIN_SIZE = 1024
+# sentence run through the models at startup, so that the first request does not pay for their warm-up
+WARMUP_SENTENCE = {
+    'words': ['The', 'cat', 'sat', '.'],
+    'lemmas': ['the', 'cat', 'sit', '.'],
+    'pos_tags': ['DT', 'NN', 'VBD', '.'],
+    'dependency_heads': [2, 3, 0, 3],
+    'dependency_relations': ['NMOD', 'SBJ', 'ROOT', 'P'],
+    'predicates': ['_', '_', 'SIT', '_'],
+}
 
+builders = {'34': build_model_34, '234': build_model_234, '1234': build_model_1234}
+load_times = {}
+load_errors = {}
+
+
+def load_model(variant):
+    name = f'model_{variant}'
+    start = time.perf_counter()
+    try:
+        return builders[variant]('cpu')
+    except Exception as e:
+        load_errors[name] = ''.join(traceback.format_exception_only(type(e), e)).strip()
+        # model_34 is mandatory, the other variants are optional
+        if variant == '34':
+            raise
+        return None
+    finally:
+        load_times[name] = time.perf_counter() - start
+
+
+class Models(Mapping):
+    """
+    The model of each variant (None if it is not available), built with load_model the first time it is requested.
+    Concurrent requests for a model being built wait for it. If building a model fails, the error is remembered and
+    raised again on later requests, rather than building it again.
+    """
+
+    def __init__(self, variants):
+        self._models = {}
+        self._errors = {}
+        self._locks = {variant: threading.Lock() for variant in variants}
+
+    def __getitem__(self, variant):
+        try:
+            return self._models[variant]
+        except KeyError:
+            pass
+        with self._locks[variant]:
+            if variant not in self._models and variant not in self._errors:
+                try:
+                    self._models[variant] = load_model(variant)
+                except Exception as e:
+                    self._errors[variant] = e
+            if variant in self._errors:
+                raise RuntimeError(f'model_{variant} could not be built') from self._errors[variant]
+            return self._models[variant]
+
+    def __iter__(self):
+        return iter(self._locks)
+
+    def __len__(self):
+        return len(self._locks)
+
+    def built(self, variant):
+        return variant in self._models or variant in self._errors
+
+    def loaded(self, variant):
+        return self._models.get(variant) is not None
+
+    def failed(self, variant):
+        return variant in self._errors
+
+
+def warm_up():
+    try:
+        pipeline.predict(models, [WARMUP_SENTENCE])
+    except Exception as e:
+        app.logger.warning(f'Warm-up failed: {e}')
+
+
+# HW2_MODEL_LOADING selects how the models are built:
+#   sequential: one after the other at startup (the default)
+#   parallel: concurrently at startup
+#   lazy: on first use, serving right away; with HW2_WARMUP=1 the first use is a warm-up request in the background
+# HW2_WARMUP=1 (the default) runs WARMUP_SENTENCE through the models once they are built
+model_loading = os.environ.get('HW2_MODEL_LOADING', 'sequential')
+warmup = os.environ.get('HW2_WARMUP', '1') == '1'
+if model_loading not in ('sequential', 'parallel', 'lazy'):
+    raise ValueError(f'Unknown HW2_MODEL_LOADING: {model_loading}')
+
+startup_start = time.perf_counter()
+models = Models(builders)
+warmup_thread = None
+if model_loading == 'sequential':
+    for variant in models:
+        models[variant]
+elif model_loading == 'parallel':
+    with ThreadPoolExecutor(max_workers=len(models)) as loader:
+        list(loader.map(models.__getitem__, models))
+if model_loading == 'lazy':
+    if warmup:
+        warmup_thread = threading.Thread(target=warm_up, name='warm-up', daemon=True)
+        warmup_thread.start()
+elif warmup:
+    warm_up()
+startup_time = time.perf_counter() - startup_start
+
+# with HW2_PARALLEL_MODELS=1, the models of the three variants run concurrently on each request
+executor = ThreadPoolExecutor(max_workers=len(models)) if os.environ.get('HW2_PARALLEL_MODELS') == '1' else None
+
+
+# predictions of deterministic models are cached, unless HW2_CACHE_SIZE=0
+cache_size = int(os.environ.get('HW2_CACHE_SIZE', 10000))
+cache = PredictionCache(cache_size) if cache_size > 0 else None
+
+
+# per-stage latencies and request counts, exposed at /metrics
+metrics = Metrics()
+# with HW2_PROFILE_SAMPLE_RATE > 0, that fraction of the requests is profiled, and the profiles of those slower than
+# HW2_PROFILE_SLOW_MS are dumped in HW2_PROFILE_DIR
+profiler = SlowRequestProfiler(
+    float(os.environ.get('HW2_PROFILE_SAMPLE_RATE', 0)),
+    float(os.environ.get('HW2_PROFILE_SLOW_MS', 1000)),
+    os.environ.get('HW2_PROFILE_DIR', 'logs/profiles'))
+
+
+def instrumented(route):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            metrics.increment('requests', route=route)
+            with profiler.profile(route), metrics.time('request_latency', route=route):
+                response = view(*args, **kwargs)
+            if isinstance(response, tuple):
+                metrics.increment('errors', route=route)
+            return response
+        return wrapper
+    return decorator
+
+
+def predict_sentences(sentences):
+    return pipeline.predict(models, sentences, executor, cache, metrics)
 
-@app.route("/", defaults={"path": ""}, methods=["POST", "GET"])
-@app.route("/<path:path>", methods=["POST", "GET"])
-def annotate(path):
+
+# with HW2_MAX_BATCH_SIZE > 1, concurrent single-sentence requests are coalesced into batches of up to
+# HW2_MAX_BATCH_SIZE sentences, waiting at most HW2_MAX_WAIT_MS for a batch to fill up
+max_batch_size = int(os.environ.get('HW2_MAX_BATCH_SIZE', 1))
+max_wait_ms = float(os.environ.get('HW2_MAX_WAIT_MS', 5))
+batcher = MicroBatcher(predict_sentences, max_batch_size, max_wait_ms) if max_batch_size > 1 else None
+
+
+def annotate_sentences(sentences, compact=False):
+    if batcher and len(sentences) == 1:
+        predictions = [batcher.submit(sentences[0])]
+    else:
+        predictions = predict_sentences(sentences)
+    return [
+        {
+            f'predictions_{variant}': utils.compact_prediction(prediction) if compact and prediction else prediction
+            for variant, prediction in sentence_predictions.items()
+        }
+        for sentence_predictions in predictions
+    ]
+
+
+def make_response(compact, **payload):
+    """
+    Serializes payload, compressing it when the client asked for the compact format, accepts gzip and the payload is
+    large enough for compression to pay off.
+    """
+    response = jsonify(**payload)
+    if compact and 'gzip' in request.headers.get('Accept-Encoding', '') and response.content_length >= GZIP_MIN_SIZE:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=1))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    # model_34 is mandatory: without it, the server cannot answer any request
+    failed = models.failed('34')
+    return jsonify(
+        status='error' if failed else 'ok',
+        model_loading=model_loading,
+        startup_time=startup_time,
+        models={
+            f'model_{variant}': {
+                'built': models.built(variant),
+                'loaded': models.loaded(variant),
+                'load_time': load_times.get(f'model_{variant}'),
+                'error': load_errors.get(f'model_{variant}'),
+            }
+            for variant in models
+        }), 503 if failed else 200
+
+
+@app.route("/cache", methods=["GET"])
+def cache_stats():
+    if cache is None:
+        return jsonify(enabled=False)
+    return jsonify(enabled=True, **cache.stats())
+
+
+@app.route("/batching", methods=["GET"])
+def batching_stats():
+    if batcher is None:
+        return jsonify(enabled=False)
+    return jsonify(enabled=True, **batcher.stats())
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_report():
+    gauges = {f'{name}_load_seconds': seconds for name, seconds in load_times.items()}
+    gauges['startup_seconds'] = startup_time
+    if cache:
+        gauges.update({f'cache_{name}': value for name, value in cache.stats().items()})
+    if batcher:
+        stats = batcher.stats()
+        gauges.update({f'batching_{name}': stats[name] for name in ('queue_depth', 'batches', 'items')})
+    return metrics.render(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.route("/batch", methods=["POST"])
+@instrumented('batch')
+def annotate_batch():
 
     try:
 
-        json_body = request.json
-        data = json_body['data']
-        data_34, data_234, data_1234 = prepare_data(data)
+        with metrics.time('stage_latency', stage='parse'):
+            json_body = request.json
+            data = json_body['data']
+            compact = json_body.get('format') == 'compact'
+        predictions = annotate_sentences(data, compact)
 
-        predictions_34 = model_34.predict(data_34)
+    except Exception as e:
 
-        if model_234:
-            predictions_234 = model_234.predict(data_234)
-        else:
-            predictions_234 = None
+        app.logger.error(e, exc_info=True)
+        return (
+            {
+                'error': 'Bad request',
+                'message': 'There was an error processing the request. Please check logs/server.stderr'
+            },
+            400
+        )
 
-        if model_1234:
-            predictions_1234 = model_1234.predict(data_1234)
-        else:
-            predictions_1234 = None
+    with metrics.time('stage_latency', stage='serialize'):
+        if not compact:
+            predictions = [dict(sentence_predictions, data=sentence) for sentence, sentence_predictions in zip(data, predictions)]
+        return make_response(compact, predictions=predictions)
 
 
+@app.route("/", defaults={"path": ""}, methods=["POST", "GET"])
+@app.route("/<path:path>", methods=["POST", "GET"])
+@instrumented('annotate')
+def annotate(path):
+
+    try:
+
+        with metrics.time('stage_latency', stage='parse'):
+            json_body = request.json
+            data = json_body['data']
+            compact = json_body.get('format') == 'compact'
+        predictions = annotate_sentences([data], compact)[0]
+
     except Exception as e:
 
         app.logger.error(e, exc_info=True)
@@ -71,11 +295,10 @@ def annotate(path):
             400
         )
 
-    return jsonify(
-        data=data,
-        predictions_34=predictions_34,
-        predictions_234=predictions_234,
-        predictions_1234=predictions_1234)
+    with metrics.time('stage_latency', stage='serialize'):
+        if not compact:
+            predictions['data'] = data
+        return make_response(compact, **predictions)
 
 
 if __name__ == '__main__':
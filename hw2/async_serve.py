@@ -0,0 +1,283 @@
+"""
+Asyncio server for app.py with bounded admission and load shedding:
+
+    python hw2/async_serve.py --workers 4 --max-queue 32 --timeout 10 --port 12345
+
+Connections are handled by an event loop, which runs the Flask application (hence the same routes and contract) on a
+pool of --workers threads. At most --workers requests run at once and at most --max-queue more wait for a thread:
+further requests are answered right away with 503 and a Retry-After header, instead of piling up. Each request must
+complete within --timeout seconds (or the X-Request-Timeout header, if shorter), otherwise it is answered with 504;
+requests whose deadline expires while they are queued are not run at all. A request keeps its admission slot until its
+thread is done with it, even after a 504, so that admission always reflects the actual load.
+
+On SIGTERM or SIGINT, idle keep-alive connections are closed right away, while the requests being served are given up
+to --graceful-timeout seconds to complete (their connections are closed once they are answered).
+"""
+import logging
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import signal
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class AsyncServer:
+
+    def __init__(self, app, workers: int, max_queue: int, timeout: float, retry_after: int, metrics=None):
+        self.app = app
+        self.capacity = workers + max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.metrics = metrics
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='wsgi')
+        self.admitted = 0
+        # the task of each open connection, and of those in the middle of a request
+        self.connections = set()
+        self.busy = set()
+        self.closing = False
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            keep_alive = True
+            while keep_alive and not self.closing:
+                try:
+                    request = await _read_request(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                except ValueError as e:
+                    await _write_response(writer, *_error('400 Bad Request', str(e)), keep_alive=False)
+                    return
+                if request is None:
+                    return
+                self.busy.add(task)
+                try:
+                    method, target, version, headers, body = request
+                    status, response_headers, response_body = await self.dispatch(method, target, version, headers, body, writer)
+                    # a shutdown may have started while the request was served
+                    keep_alive = _keep_alive(version, headers) and not self.closing
+                    await _write_response(writer, status, response_headers, response_body, keep_alive)
+                finally:
+                    self.busy.discard(task)
+        except ConnectionError:
+            pass
+        except asyncio.CancelledError:
+            # cancelled by shutdown: idle connections right away, busy ones after the graceful timeout
+            pass
+        finally:
+            writer.close()
+            self.connections.discard(task)
+
+    async def shutdown(self, graceful_timeout: float):
+        """
+        Closes the idle connections, waits at most graceful_timeout seconds for the requests being served and then
+        closes the connections left.
+        """
+        self.closing = True
+        for task in self.connections - self.busy:
+            task.cancel()
+        if self.busy:
+            logging.info(f'Waiting for the {len(self.busy)} requests being served')
+            await asyncio.wait(set(self.busy), timeout=graceful_timeout)
+        for task in self.connections:
+            task.cancel()
+        if self.connections:
+            await asyncio.wait(set(self.connections))
+        self.executor.shutdown(wait=False)
+
+    async def dispatch(self, method, target, version, headers, body, writer):
+        if self.admitted >= self.capacity:
+            self._count('shed', reason='queue_full')
+            return _error('503 Service Unavailable', 'server overloaded', [('Retry-After', str(self.retry_after))])
+
+        timeout = self.timeout
+        if 'x-request-timeout' in headers:
+            try:
+                timeout = min(timeout, float(headers['x-request-timeout']))
+            except ValueError:
+                pass
+        deadline = time.monotonic() + timeout
+
+        environ = _make_environ(method, target, version, headers, body, writer)
+        self.admitted += 1
+        future = asyncio.get_event_loop().run_in_executor(self.executor, self._run_app, environ, deadline)
+        # the slot is released when the thread is done with the request, not when the client gets its answer
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.TimeoutError, DeadlineExceeded):
+            self._count('shed', reason='deadline_exceeded')
+            return _error('504 Gateway Timeout', 'deadline exceeded')
+        except Exception as e:
+            logging.error(e, exc_info=True)
+            return _error('500 Internal Server Error', 'internal server error')
+
+    def _release(self, future):
+        self.admitted -= 1
+        # retrieve the exception (if any) of requests that timed out, so that it is not reported as never retrieved
+        if not future.cancelled():
+            future.exception()
+
+    def _run_app(self, environ, deadline):
+        if time.monotonic() >= deadline:
+            raise DeadlineExceeded()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'], response['headers'] = status, headers
+
+        result = self.app(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], body
+
+    def _count(self, name, **labels):
+        if self.metrics:
+            self.metrics.increment(name, **labels)
+
+
+async def _read_request(reader: asyncio.StreamReader):
+    """
+    Reads a request, returning (method, target, version, headers, body), or None if the connection was closed
+    between requests.
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise
+    except asyncio.LimitOverrunError:
+        raise ValueError('request headers too large')
+
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise ValueError(f'malformed request line: {lines[0]!r}')
+
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        raise ValueError('chunked requests are not supported')
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, target, version, headers, body
+
+
+def _keep_alive(version, headers):
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+        return connection != 'close'
+    return connection == 'keep-alive'
+
+
+def _make_environ(method, target, version, headers, body, writer):
+    path, _, query = target.partition('?')
+    host, port = writer.get_extra_info('sockname')[:2]
+    peer = writer.get_extra_info('peername')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote(path, encoding='latin-1'),
+        'QUERY_STRING': query,
+        'SERVER_NAME': str(host),
+        'SERVER_PORT': str(port),
+        'SERVER_PROTOCOL': version,
+        'REMOTE_ADDR': peer[0] if peer else '',
+        'CONTENT_TYPE': headers.get('content-type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in headers.items():
+        if name not in ('content-type', 'content-length'):
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+    return environ
+
+
+def _error(status, message, headers=()):
+    return status, [('Content-Type', 'application/json'), *headers], json.dumps({'error': message}).encode('utf-8')
+
+
+async def _write_response(writer, status, headers, body, keep_alive):
+    lines = [f'HTTP/1.1 {status}']
+    lines.extend(f'{name}: {value}' for name, value in headers if name.lower() not in ('content-length', 'connection'))
+    lines.append(f'Content-Length: {len(body)}')
+    lines.append(f'Connection: {"keep-alive" if keep_alive else "close"}')
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+
+
+async def main(host: str, port: int, workers: int, max_queue: int, timeout: float, retry_after: int, graceful_timeout: float):
+
+    # importing app builds the models
+    from app import app, metrics
+
+    server = AsyncServer(app, workers, max_queue, timeout, retry_after, metrics)
+    listener = await asyncio.start_server(server.handle_connection, host, port, limit=MAX_HEADER_SIZE)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+
+    logging.info(f'Serving on {host}:{port} with {workers} workers and a queue of {max_queue} requests')
+    async with listener:
+        await stopping.wait()
+
+        logging.info('Shutting down')
+        listener.close()
+        await server.shutdown(graceful_timeout)
+        await listener.wait_closed()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve app.py with asyncio, bounded admission and load shedding')
+    parser.add_argument("--host", type=str, default=os.environ.get('HW2_HOST', '0.0.0.0'), help='Address to bind')
+    parser.add_argument("--port", type=int, default=int(os.environ.get('HW2_PORT', 12345)), help='Port to bind')
+    parser.add_argument("--workers", type=int, default=int(os.environ.get('HW2_WORKERS', os.cpu_count())), help='Threads running the requests')
+    parser.add_argument("--max-queue", type=int, default=int(os.environ.get('HW2_MAX_QUEUE', 64)), help='Requests waiting for a thread before shedding')
+    parser.add_argument("--timeout", type=float, default=float(os.environ.get('HW2_REQUEST_TIMEOUT', 30)), help='Seconds within which each request must complete')
+    parser.add_argument("--retry-after", type=int, default=1, help='Seconds suggested to the clients of shed requests')
+    parser.add_argument("--graceful-timeout", type=float, default=30.0, help='Seconds given to the requests being served on shutdown')
+    args = parser.parse_args()
+
+    asyncio.run(main(
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        max_queue=args.max_queue,
+        timeout=args.timeout,
+        retry_after=args.retry_after,
+        graceful_timeout=args.graceful_timeout
+    ))
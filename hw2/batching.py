@@ -0,0 +1,85 @@
+import queue
+import threading
+import time
+
+from collections import Counter
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Coalesces the items submitted concurrently by many threads into batches of at most max_batch_size items, waiting at
+    most max_wait_ms after the first item of a batch for the others to arrive. Batches are processed one at a time by
+    a background thread with process_batch, a function mapping a list of items to the list of their results.
+
+    The worker thread is started on the first submit, so that a MicroBatcher can be safely created before forking.
+    """
+
+    def __init__(self, process_batch, max_batch_size: int, max_wait_ms: float):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batch_sizes = Counter()
+        self.queue_depths = Counter()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, item):
+        """
+        Queues item and blocks until its result is available, re-raising the exception raised while processing it.
+        """
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                    self._thread.start()
+
+        future = Future()
+        self._queue.put((item, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # the requests still waiting when the batch is formed
+            self.queue_depths[self._queue.qsize()] += 1
+            self.batch_sizes[len(batch)] += 1
+            self._process(batch)
+
+    def _process(self, batch):
+        try:
+            results = self.process_batch([item for item, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # do not let a single bad item fail the whole batch: process the items one by one
+            for entry in batch:
+                self._process([entry])
+            return
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def stats(self) -> dict:
+        batch_sizes, queue_depths = dict(self.batch_sizes), dict(self.queue_depths)
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'queue_depth': self._queue.qsize(),
+            'batches': sum(batch_sizes.values()),
+            'items': sum(size * count for size, count in batch_sizes.items()),
+            'batch_size_histogram': {str(size): count for size, count in sorted(batch_sizes.items())},
+            'queue_depth_histogram': {str(depth): count for depth, count in sorted(queue_depths.items())},
+        }
@@ -0,0 +1,281 @@
+"""
+Benchmarks of the baseline model, of the prediction pipeline, of the scorers in utils and of the HTTP path through
+app.py, on synthetic sentences whose POS tags, dependency relations and lemmas are sampled from the empirical tables in
+data/baselines.json.
+
+    python hw2/benchmark.py --sentences 2000 --length 25 --predicate-density 0.15 --output benchmark.json
+    python hw2/benchmark.py --compare benchmark.json --threshold 0.1
+
+Run it from the root directory of the project (the models load data/baselines.json from there). With --compare, the
+run fails if the throughput of any benchmark dropped by more than --threshold with respect to the given results.
+"""
+import logging
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+import argparse
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+
+import numpy as np
+from typing import Callable, Dict, List
+
+import pipeline
+import utils
+from stud.implementation import Baseline
+
+
+def generate_sentences(baselines, n: int, length: int, predicate_density: float, seed: int = 0):
+    """
+    Generates n synthetic sentences of length tokens, each token being a predicate with probability
+    predicate_density. POS tags and dependency relations are sampled according to their frequency in the baselines,
+    lemmas uniformly among the ones with a known sense, and the gold roles of each predicate follow the argument
+    identification and classification tables. Dependency heads form a random tree rooted at the first token.
+
+    Returns:
+        A pair (sentences, labels) of dictionaries keyed by sentence id, in the format of utils.read_dataset.
+    """
+    rng = np.random.default_rng(seed)
+
+    pos_counts = baselines['predicate_identification']
+    pos_tags = np.array(list(pos_counts), dtype=object)
+    pos_weights = np.array([counts['total'] for counts in pos_counts.values()], dtype=np.float64)
+
+    relation_counts = baselines['argument_identification']
+    relations = np.array(list(relation_counts), dtype=object)
+    relation_weights = np.array([counts['total'] for counts in relation_counts.values()], dtype=np.float64)
+    argument_probs = np.array([counts['positive'] / counts['total'] if counts['total'] else 0.0 for counts in relation_counts.values()])
+    argument_labels = np.array([baselines['argument_classification'].get(relation, '_') for relation in relation_counts], dtype=object)
+
+    lemmas = np.array(list(baselines['predicate_disambiguation']), dtype=object)
+    senses = np.array(list(baselines['predicate_disambiguation'].values()), dtype=object)
+
+    sentences, labels = {}, {}
+    for sentence_id in range(n):
+        pos_ids = rng.choice(len(pos_tags), size=length, p=pos_weights / pos_weights.sum())
+        relation_ids = rng.choice(len(relations), size=length, p=relation_weights / relation_weights.sum())
+        lemma_ids = rng.integers(len(lemmas), size=length)
+
+        predicates = np.where(rng.random(length) < predicate_density, senses[lemma_ids], '_').tolist()
+        roles = {}
+        for i in (j for j, predicate in enumerate(predicates) if predicate != '_'):
+            roles[i] = np.where(rng.random(length) < argument_probs[relation_ids], argument_labels[relation_ids], '_').tolist()
+
+        sentences[sentence_id] = {
+            'words': lemmas[lemma_ids].tolist(),
+            'lemmas': lemmas[lemma_ids].tolist(),
+            'pos_tags': pos_tags[pos_ids].tolist(),
+            'dependency_heads': [0] + [int(rng.integers(1, i + 1)) for i in range(1, length)],
+            'dependency_relations': relations[relation_ids].tolist(),
+            'predicates': predicates,
+        }
+        labels[sentence_id] = {'predicates': predicates, 'roles': roles}
+
+    return sentences, labels
+
+
+def measure(name: str, function: Callable, items: int, repeats: int) -> Dict:
+    """
+    Runs function repeats times and reports the median time and the throughput (items per second), followed by one
+    more run under tracemalloc for the peak memory allocated by function.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    seconds = statistics.median(times)
+    result = {
+        'items': items,
+        'repeats': repeats,
+        'seconds': seconds,
+        'min_seconds': min(times),
+        'throughput': items / seconds if seconds else float('inf'),
+        'peak_memory_bytes': peak_memory,
+    }
+    logging.info(f'{name}: {result["throughput"]:.1f} items/s (median {seconds * 1000:.2f}ms), peak memory {peak_memory / 2 ** 20:.2f}MiB')
+    return result
+
+
+def benchmark_model(sentences: List[Dict], repeats: int) -> Dict:
+    model = Baseline(return_predicates=True, seed=0)
+    return {
+        'baseline_predict': measure('baseline_predict', lambda: [model.predict(s) for s in sentences], len(sentences), repeats),
+        'baseline_predict_batch': measure('baseline_predict_batch', lambda: model.predict_batch(sentences), len(sentences), repeats),
+    }
+
+
+def _prepare_separately(data):
+    # the inputs of the three variants as app.py prepared them before pipeline.prepare_data
+    shared = {field: data[field] for field in pipeline.SHARED_FIELDS}
+    return data, dict(shared, predicates=[1 if p != '_' else 0 for p in data['predicates']]), dict(shared)
+
+
+def benchmark_pipeline(sentences: List[Dict], repeats: int) -> Dict:
+    """
+    Runs a Baseline for each variant through pipeline.predict, which shares the per-sentence work among them, and, for
+    reference, on separately prepared inputs one variant after the other, both one sentence at a time (as the server
+    does for each request) and in a single batch.
+    """
+    models = {'34': Baseline(seed=0), '234': Baseline(return_predicates=True, seed=0), '1234': Baseline(return_predicates=True, seed=0)}
+
+    def separate(sentence):
+        return [models[variant].predict(data) for variant, data in zip(pipeline.VARIANTS, _prepare_separately(sentence))]
+
+    def separate_batch(batch):
+        inputs = zip(*map(_prepare_separately, batch))
+        return [models[variant].predict_batch(list(batch_inputs)) for variant, batch_inputs in zip(pipeline.VARIANTS, inputs)]
+
+    benchmarks = {
+        'pipeline_separate_single': lambda: [separate(s) for s in sentences],
+        'pipeline_shared_single': lambda: [pipeline.predict(models, [s]) for s in sentences],
+        'pipeline_separate_batch': lambda: separate_batch(sentences),
+        'pipeline_shared_batch': lambda: pipeline.predict(models, sentences),
+    }
+    return {name: measure(name, function, len(sentences), repeats) for name, function in benchmarks.items()}
+
+
+def benchmark_scorers(labels: Dict, sentences: Dict, repeats: int) -> Dict:
+    model = Baseline(return_predicates=True, seed=0)
+    predictions = dict(zip(sentences, model.predict_batch(list(sentences.values()))))
+
+    scorers = {
+        'evaluate_predicate_identification': utils.evaluate_predicate_identification,
+        'evaluate_predicate_disambiguation': utils.evaluate_predicate_disambiguation,
+        'evaluate_argument_identification': utils.evaluate_argument_identification,
+        'evaluate_argument_classification': utils.evaluate_argument_classification,
+        'evaluate_all': utils.evaluate_all,
+    }
+    return {
+        name: measure(name, lambda scorer=scorer: scorer(labels, predictions), len(labels), repeats)
+        for name, scorer in scorers.items()
+    }
+
+
+def benchmark_http(sentences: List[Dict], repeats: int, endpoint: str = None) -> Dict:
+    """
+    Posts every sentence, one request at a time, to endpoint or, if no endpoint is given, to app.py in process
+    (through the Flask test client, i.e. without the network but with the whole request handling).
+    """
+    if endpoint:
+        import requests
+        session = requests.Session()
+        post = lambda payload: session.post(endpoint, json=payload).raise_for_status()
+    else:
+        from app import app
+        client = app.test_client()
+
+        def post(payload):
+            response = client.post('/', json=payload)
+            if response.status_code != 200:
+                raise RuntimeError(f'The server answered {response.status_code}: {response.get_data(as_text=True)}')
+
+    results = {}
+    for response_format in ('full', 'compact'):
+        name = f'http_{response_format}'
+        results[name] = measure(name, lambda: [post({'data': s, 'format': response_format}) for s in sentences], len(sentences), repeats)
+    return results
+
+
+def compare(results: Dict, reference: Dict, threshold: float) -> List[str]:
+    """
+    Returns a description of each benchmark whose throughput is more than threshold (a fraction) below the reference.
+    """
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        if name not in reference['benchmarks']:
+            continue
+        before, after = reference['benchmarks'][name]['throughput'], result['throughput']
+        change = after / before - 1
+        logging.info(f'{name}: {before:.1f} -> {after:.1f} items/s ({change:+.1%})')
+        if change < -threshold:
+            regressions.append(f'{name} throughput dropped by {-change:.1%} ({before:.1f} -> {after:.1f} items/s)')
+    return regressions
+
+
+def main(
+        sentences: int, length: int, predicate_density: float, repeats: int, seed: int, suites: List[str],
+        endpoint: str, output: str, reference: str, threshold: float
+):
+
+    with open('data/baselines.json') as f:
+        baselines = json.load(f)
+    sentences, labels = generate_sentences(baselines, sentences, length, predicate_density, seed)
+
+    benchmarks = {}
+    if 'model' in suites:
+        benchmarks.update(benchmark_model(list(sentences.values()), repeats))
+    if 'pipeline' in suites:
+        benchmarks.update(benchmark_pipeline(list(sentences.values()), repeats))
+    if 'scorers' in suites:
+        benchmarks.update(benchmark_scorers(labels, sentences, repeats))
+    if 'http' in suites:
+        benchmarks.update(benchmark_http(list(sentences.values()), repeats, endpoint))
+
+    results = {
+        'config': {
+            'sentences': len(sentences),
+            'length': length,
+            'predicate_density': predicate_density,
+            'repeats': repeats,
+            'seed': seed,
+            'endpoint': endpoint,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+        },
+        'benchmarks': benchmarks,
+    }
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if reference:
+        with open(reference) as f:
+            regressions = compare(results, json.load(f), threshold)
+        for regression in regressions:
+            logging.error(regression)
+        if regressions:
+            exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the baseline, the scorers and the server on synthetic sentences')
+    parser.add_argument("--sentences", type=int, default=1000, help='Number of synthetic sentences')
+    parser.add_argument("--length", type=int, default=25, help='Number of tokens of each sentence')
+    parser.add_argument("--predicate-density", type=float, default=0.15, help='Probability of each token being a predicate')
+    parser.add_argument("--repeats", type=int, default=5, help='Timed runs of each benchmark')
+    parser.add_argument("--seed", type=int, default=0, help='Seed of the sentence generator')
+    parser.add_argument("--suites", nargs='+', choices=['model', 'pipeline', 'scorers', 'http'], default=['model', 'pipeline', 'scorers', 'http'], help='Benchmarks to run')
+    parser.add_argument("--endpoint", type=str, default=None, help='Benchmark a running server instead of app.py in process')
+    parser.add_argument("--output", type=str, default=None, help='File where the results are written as JSON')
+    parser.add_argument("--compare", type=str, default=None, help='Results of a previous run to check for regressions')
+    parser.add_argument("--threshold", type=float, default=0.1, help='Largest tolerated throughput drop, as a fraction')
+    args = parser.parse_args()
+
+    main(
+        sentences=args.sentences,
+        length=args.length,
+        predicate_density=args.predicate_density,
+        repeats=args.repeats,
+        seed=args.seed,
+        suites=args.suites,
+        endpoint=args.endpoint,
+        output=args.output,
+        reference=args.compare,
+        threshold=args.threshold
+    )
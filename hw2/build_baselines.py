@@ -0,0 +1,210 @@
+"""
+Builds the baseline tables read by stud.implementation.Baseline (data/baselines.json) from a training set in the format
+of utils.read_dataset:
+
+    python hw2/build_baselines.py data/train.json --output data/baselines.json
+
+The dataset is streamed in shards of --shard-size sentences, counted in parallel by a pool of --processes workers, and
+the counts of the shards are merged. Besides the tables, the full counts are saved next to the output (e.g. in
+data/baselines.counts.json), so that a new slice of data can be added without recounting the old ones:
+
+    python hw2/build_baselines.py data/new_slice.json --update data/baselines.json --output data/baselines.json
+
+Without the counts file, the counts are seeded from the tables of the file to update: the identification counts are
+exact, but only the most frequent role of each relation and sense of each lemma are known, so that the updated
+classification and disambiguation tables are an approximation.
+"""
+import logging
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+import argparse
+import json
+import multiprocessing
+import os
+
+from collections import Counter, defaultdict
+from itertools import islice
+from typing import Dict, Iterable, Tuple
+
+import utils
+
+
+class BaselineCounts:
+    """
+    The counts behind the baseline tables:
+        - predicate_identification: for each POS tag, its predicate (positive) and total occurrences;
+        - argument_identification: for each dependency relation, over all the (predicate, token) pairs of the sentences
+          where the token has that relation, how many are arguments (positive) and how many they are in total;
+        - argument_classification: for each dependency relation, the occurrences of each role of those arguments;
+        - predicate_disambiguation: for each lemma, the occurrences of each sense of its predicates.
+    """
+
+    def __init__(self):
+        self.predicate_positives = Counter()
+        self.predicate_totals = Counter()
+        self.argument_positives = Counter()
+        self.argument_totals = Counter()
+        self.roles = defaultdict(Counter)
+        self.senses = defaultdict(Counter)
+
+    def add(self, sentence: Dict, label: Dict, null_tag: str = '_'):
+        predicates = label['predicates']
+        self.predicate_totals.update(sentence['pos_tags'])
+        self.predicate_positives.update(pos for pos, predicate in zip(sentence['pos_tags'], predicates) if predicate != null_tag)
+        for lemma, predicate in zip(sentence['lemmas'], predicates):
+            if predicate != null_tag:
+                self.senses[lemma][predicate] += 1
+
+        relations = sentence['dependency_relations']
+        for relation, count in Counter(relations).items():
+            self.argument_totals[relation] += count * len(label['roles'])
+        for roles in label['roles'].values():
+            for relation, role in zip(relations, roles):
+                if role != null_tag:
+                    self.argument_positives[relation] += 1
+                    self.roles[relation][role] += 1
+
+    def update(self, other: 'BaselineCounts'):
+        self.predicate_positives.update(other.predicate_positives)
+        self.predicate_totals.update(other.predicate_totals)
+        self.argument_positives.update(other.argument_positives)
+        self.argument_totals.update(other.argument_totals)
+        for relation, roles in other.roles.items():
+            self.roles[relation].update(roles)
+        for lemma, senses in other.senses.items():
+            self.senses[lemma].update(senses)
+
+    def to_baselines(self) -> Dict:
+        return {
+            'argument_classification': {relation: _most_common(roles) for relation, roles in self.roles.items() if roles},
+            'argument_identification': {
+                relation: {'positive': self.argument_positives[relation], 'total': total}
+                for relation, total in self.argument_totals.items()
+            },
+            'predicate_disambiguation': {lemma: _most_common(senses) for lemma, senses in self.senses.items() if senses},
+            'predicate_identification': {
+                pos: {'positive': self.predicate_positives[pos], 'total': total}
+                for pos, total in self.predicate_totals.items()
+            },
+        }
+
+    def to_json(self) -> Dict:
+        return {
+            'predicate_positives': self.predicate_positives,
+            'predicate_totals': self.predicate_totals,
+            'argument_positives': self.argument_positives,
+            'argument_totals': self.argument_totals,
+            'roles': self.roles,
+            'senses': self.senses,
+        }
+
+    @staticmethod
+    def from_json(state: Dict) -> 'BaselineCounts':
+        counts = BaselineCounts()
+        counts.predicate_positives.update(state['predicate_positives'])
+        counts.predicate_totals.update(state['predicate_totals'])
+        counts.argument_positives.update(state['argument_positives'])
+        counts.argument_totals.update(state['argument_totals'])
+        for relation, roles in state['roles'].items():
+            counts.roles[relation].update(roles)
+        for lemma, senses in state['senses'].items():
+            counts.senses[lemma].update(senses)
+        return counts
+
+    @staticmethod
+    def from_baselines(baselines: Dict) -> 'BaselineCounts':
+        """
+        Approximates the counts behind baselines, where the most frequent role of each relation is assumed to cover all
+        its arguments, and the most frequent sense of each lemma to occur once.
+        """
+        counts = BaselineCounts()
+        for pos, pos_counts in baselines['predicate_identification'].items():
+            counts.predicate_positives[pos] = pos_counts['positive']
+            counts.predicate_totals[pos] = pos_counts['total']
+        for relation, relation_counts in baselines['argument_identification'].items():
+            counts.argument_positives[relation] = relation_counts['positive']
+            counts.argument_totals[relation] = relation_counts['total']
+        for relation, role in baselines['argument_classification'].items():
+            counts.roles[relation][role] = counts.argument_positives[relation]
+        for lemma, sense in baselines['predicate_disambiguation'].items():
+            counts.senses[lemma][sense] = 1
+        return counts
+
+
+def _most_common(counter: Counter) -> str:
+    # ties are broken alphabetically, so that the result does not depend on the order in which shards are merged
+    return min(counter, key=lambda label: (-counter[label], label))
+
+
+def _count_shard(shard) -> BaselineCounts:
+    counts = BaselineCounts()
+    for sentence, label in shard:
+        counts.add(sentence, label)
+    return counts
+
+
+def _shards(path: str, shard_size: int) -> Iterable[Tuple]:
+    sentences = ((sentence, label) for _, sentence, label in utils.iter_dataset(path))
+    while True:
+        shard = list(islice(sentences, shard_size))
+        if not shard:
+            return
+        yield shard
+
+
+def count_dataset(path: str, processes: int = None, shard_size: int = 1000) -> BaselineCounts:
+    counts = BaselineCounts()
+    with multiprocessing.Pool(processes) as pool:
+        for shard_counts in pool.imap_unordered(_count_shard, _shards(path, shard_size)):
+            counts.update(shard_counts)
+    return counts
+
+
+def counts_path(baselines_path: str) -> str:
+    return f'{os.path.splitext(baselines_path)[0]}.counts.json'
+
+
+def main(dataset_path: str, output_path: str, update_path: str, processes: int, shard_size: int):
+
+    counts = BaselineCounts()
+    if update_path:
+        if os.path.exists(counts_path(update_path)):
+            with open(counts_path(update_path)) as f:
+                counts = BaselineCounts.from_json(json.load(f))
+        else:
+            logging.warning(
+                f'{counts_path(update_path)} not found: the counts are seeded from {update_path}, so the updated '
+                f'argument classification and predicate disambiguation tables are approximate')
+            with open(update_path) as f:
+                counts = BaselineCounts.from_baselines(json.load(f))
+
+    counts.update(count_dataset(dataset_path, processes, shard_size))
+    baselines = counts.to_baselines()
+
+    with open(output_path, 'w') as f:
+        json.dump(baselines, f, indent=4, sort_keys=True)
+    with open(counts_path(output_path), 'w') as f:
+        json.dump(counts.to_json(), f, sort_keys=True)
+
+    logging.info(
+        f'Written {output_path}: {len(baselines["predicate_identification"])} POS tags, '
+        f'{len(baselines["argument_identification"])} relations, {len(baselines["predicate_disambiguation"])} lemmas')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the baseline tables from a training set')
+    parser.add_argument("file", type=str, help='Training set, in the format of read_dataset')
+    parser.add_argument("--output", type=str, default='data/baselines.json', help='File where the tables are written')
+    parser.add_argument("--update", type=str, default=None, help='Tables (and counts) to which the training set is added')
+    parser.add_argument("--processes", type=int, default=None, help='Counting processes (default: one per CPU)')
+    parser.add_argument("--shard-size", type=int, default=1000, help='Sentences counted at once by each process')
+    args = parser.parse_args()
+
+    main(
+        dataset_path=args.file,
+        output_path=args.output,
+        update_path=args.update,
+        processes=args.processes,
+        shard_size=args.shard_size
+    )
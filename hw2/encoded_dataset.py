@@ -0,0 +1,149 @@
+import argparse
+import json
+import os
+
+import numpy as np
+from array import array
+from collections.abc import Mapping
+
+import utils
+
+
+TOKEN_FIELDS = ('words', 'lemmas', 'pos_tags', 'dependency_relations', 'predicates')
+VOCABULARIES_FILE = 'vocabularies.json'
+
+
+def build_encoded_dataset(dataset_path: str, output_path: str):
+    """
+    Encodes the dataset stored in dataset_path (in any format accepted by utils.iter_dataset) into output_path, a
+    directory of .npy arrays that EncodedDataset can memory-map:
+        - sentence_ids: the id of each sentence;
+        - offsets: sentence i spans tokens offsets[i]:offsets[i + 1] of the token arrays;
+        - one token array of ids for each of TOKEN_FIELDS, plus dependency_heads;
+        - role_offsets: the roles of sentence i are the entries role_offsets[i]:role_offsets[i + 1] of role_predicates;
+        - role_predicates: the predicate index of each entry;
+        - role_token_offsets: the roles of entry j are roles[role_token_offsets[j]:role_token_offsets[j + 1]];
+        - roles: the role ids, one for each token of the sentence of each entry.
+    The vocabularies of the string fields (and of roles) are stored in vocabularies.json.
+    """
+    vocabularies = {field: {} for field in TOKEN_FIELDS + ('roles',)}
+    tokens = {field: array('i') for field in TOKEN_FIELDS + ('dependency_heads',)}
+    sentence_ids, offsets = array('q'), array('q', [0])
+    role_offsets, role_predicates, role_token_offsets, roles = array('q', [0]), array('i'), array('q', [0]), array('i')
+
+    def encode(field, values, output):
+        vocabulary = vocabularies[field]
+        output.extend(vocabulary.setdefault(value, len(vocabulary)) for value in values)
+
+    for sentence_id, sentence, label in utils.iter_dataset(dataset_path):
+        sentence_ids.append(sentence_id)
+        offsets.append(offsets[-1] + len(sentence['words']))
+        for field in TOKEN_FIELDS:
+            encode(field, sentence[field], tokens[field])
+        tokens['dependency_heads'].extend(sentence['dependency_heads'])
+
+        for predicate_index, predicate_roles in sorted(label['roles'].items()):
+            role_predicates.append(predicate_index)
+            encode('roles', predicate_roles, roles)
+            role_token_offsets.append(len(roles))
+        role_offsets.append(len(role_predicates))
+
+    os.makedirs(output_path, exist_ok=True)
+    arrays = dict(tokens, sentence_ids=sentence_ids, offsets=offsets, role_offsets=role_offsets,
+                  role_predicates=role_predicates, role_token_offsets=role_token_offsets, roles=roles)
+    for name, values in arrays.items():
+        np.save(os.path.join(output_path, f'{name}.npy'), np.frombuffer(values, dtype=values.typecode))
+
+    with open(os.path.join(output_path, VOCABULARIES_FILE), 'w') as f:
+        json.dump({field: list(vocabulary) for field, vocabulary in vocabularies.items()}, f)
+
+
+def encoded_dataset_size(path: str) -> int:
+    """
+    Returns the number of sentences of the dataset encoded in path, reading only the header of its sentence ids.
+    """
+    return len(np.load(os.path.join(path, 'sentence_ids.npy'), mmap_mode='r'))
+
+
+class EncodedDataset:
+    """
+    A dataset built by build_encoded_dataset. The arrays are memory-mapped, so opening it does not read them, and
+    processes opening the same dataset share the same pages. Sentences and labels are decoded lazily, field by field.
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, VOCABULARIES_FILE)) as f:
+            self.vocabularies = {field: np.array(tokens, dtype=object) for field, tokens in json.load(f).items()}
+        self.arrays = {
+            name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode='r')
+            for name in os.listdir(path) if name.endswith('.npy')
+        }
+        self.sentence_ids = self.arrays['sentence_ids']
+        self.offsets = self.arrays['offsets']
+
+    def __len__(self):
+        return len(self.sentence_ids)
+
+    def __iter__(self):
+        """
+        Yields (sentence_id, sentence, label) triples, as utils.iter_dataset does.
+        """
+        for i in range(len(self)):
+            yield int(self.sentence_ids[i]), self.sentence(i), self.label(i)
+
+    def sentence(self, i: int) -> 'EncodedSentence':
+        return EncodedSentence(self, int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def label(self, i: int) -> dict:
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        role_start, role_end = int(self.arrays['role_offsets'][i]), int(self.arrays['role_offsets'][i + 1])
+        predicate_indices = self.arrays['role_predicates'][role_start:role_end].tolist()
+        token_offsets = self.arrays['role_token_offsets'][role_start:role_end + 1].tolist()
+        roles = {
+            predicate_index: self.decode('roles', self.arrays['roles'][token_start:token_end])
+            for predicate_index, token_start, token_end in zip(predicate_indices, token_offsets, token_offsets[1:])
+        }
+        return {
+            'predicates': self.decode('predicates', self.arrays['predicates'][start:end]),
+            'roles': roles,
+        }
+
+    def decode(self, field: str, ids: np.ndarray) -> list:
+        return self.vocabularies[field][ids].tolist()
+
+
+class EncodedSentence(Mapping):
+    """
+    A read-only view of a sentence of an EncodedDataset that behaves like the dictionaries returned by
+    utils.read_dataset, decoding each field only when it is accessed.
+    """
+
+    FIELDS = ('words', 'lemmas', 'pos_tags', 'dependency_heads', 'dependency_relations', 'predicates')
+
+    def __init__(self, dataset: EncodedDataset, start: int, end: int):
+        self.dataset = dataset
+        self.start = start
+        self.end = end
+
+    def __getitem__(self, field):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        ids = self.dataset.arrays[field][self.start:self.end]
+        if field == 'dependency_heads':
+            return ids.tolist()
+        return self.dataset.decode(field, ids)
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Encode a dataset into a directory of memory-mappable arrays')
+    parser.add_argument("file", type=str, help='Dataset to encode')
+    parser.add_argument("output", type=str, help='Directory where the encoded dataset is written')
+    args = parser.parse_args()
+
+    build_encoded_dataset(args.file, args.output)
@@ -4,21 +4,64 @@ logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
 
 import argparse
 import json
+import multiprocessing
+import os
 import pprint
 import requests
+import threading
 import time
 
-from requests.exceptions import ConnectionError
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+from requests.exceptions import ConnectionError, Timeout
 from tqdm import tqdm
 from typing import Tuple, List, Any, Dict
 
+import pipeline
 import utils
+from predictions_log import PredictionsLog
+from slices import FEATURES, print_slices, slice_scores
+
+
+def wait_for_server(endpoint: str, timeout: float, initial_delay: float = 0.1, max_delay: float = 2.0) -> bool:
+    """
+    Polls the /health route of the server with exponential backoff until it answers or timeout seconds have passed.
+    Returns whether the server is up.
+    """
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+
+    while True:
+
+        try:
+            response = requests.get(f'{endpoint}/health', timeout=10)
+            if response.status_code == 200:
+                for name, status in response.json()['models'].items():
+                    if status['loaded']:
+                        logging.info(f'{name} loaded in {status["load_time"]:.2f} seconds')
+                    else:
+                        logging.info(f'{name} not available')
+                logging.info('Connection succeded')
+                return True
+        except (ConnectionError, Timeout) as e:
+            pass
 
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        logging.info(f'Waiting for server to go up: next trial in {min(delay, remaining):.1f} seconds')
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
 
-def main(test_path: str, endpoint: str):
 
+def read_dataset(test_path: str):
+    """
+    Streams (sentence_id, sentence, label) triples from test_path, exiting with an error if the file cannot be read.
+    """
     try:
-        sentences, labels = utils.read_dataset(test_path)
+        yield from utils.iter_dataset(test_path)
     except FileNotFoundError as e:
         logging.error(f'Evaluation crashed because {test_path} does not exist')
         exit(1)
@@ -28,97 +71,287 @@ def main(test_path: str, endpoint: str):
         logging.error(e, exc_info=True)
         exit(1)
 
-    max_try = 10
-    iterator = iter(range(max_try))
 
-    while True:
+def print_results(labels, predictions_34, predictions_234, predictions_1234):
+
+    print('MODEL: ARGUMENT IDENTIFICATION + ARGUMENT CLASSIFICATION')
+    results = utils.evaluate_all(labels, predictions_34, tasks=utils.VARIANT_TASKS['34'])
+    print(utils.print_table('argument identification', results['argument_identification']))
+    print(utils.print_table('argument classification', results['argument_classification']))
+
+    if predictions_234:
+        print('MODEL: PREDICATE DISAMBIGUATION + ARGUMENT IDENTIFICATION + ARGUMENT CLASSIFICATION')
+        results = utils.evaluate_all(labels, predictions_234, tasks=utils.VARIANT_TASKS['234'])
+        print(utils.print_table('predicate disambiguation', results['predicate_disambiguation']))
+        print(utils.print_table('argument identification', results['argument_identification']))
+        print(utils.print_table('argument classification', results['argument_classification']))
+
+    if predictions_1234:
+        print('MODEL: PREDICATE IDENTIFICATION + PREDICATE DISAMBIGUATION + ARGUMENT IDENTIFICATION + ARGUMENT CLASSIFICATION')
+        results = utils.evaluate_all(labels, predictions_1234, tasks=utils.VARIANT_TASKS['1234'])
+        print(utils.print_table('predicate identification', results['predicate_identification']))
+        print(utils.print_table('predicate disambiguation', results['predicate_disambiguation']))
+        print(utils.print_table('argument identification', results['argument_identification']))
+        print(utils.print_table('argument classification', results['argument_classification']))
+
+
+def print_latencies(latencies, elapsed):
+    if not latencies:
+        return
+    latencies = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f'{len(latencies)} requests in {elapsed:.2f}s ({len(latencies) / elapsed:.1f} sentences/s)')
+    print(f'Latency (ms): mean {latencies.mean():.1f}, p50 {p50:.1f}, p95 {p95:.1f}, p99 {p99:.1f}')
+    print()
 
-        try:
-            i = next(iterator)
-        except StopIteration:
-            logging.error(f'Impossible to establish a connection to the server even after 10 tries')
-            logging.error('The server is not booting and, most likely, you have some error in build_model or StudentClass')
-            logging.error('You can find more information inside logs/. Checkout both server.stdout and, most importantly, server.stderr')
-            exit(1)
 
-        logging.info(f'Waiting 10 second for server to go up: trial {i}/{max_try}')
-        time.sleep(10)
+# models built once by each process of the offline pool (or the error raised building model_34)
+_offline_models = None
 
+
+def _init_offline_worker():
+    global _offline_models
+    from stud.implementation import build_model_34, build_model_234, build_model_1234
+
+    try:
+        _offline_models = {'34': build_model_34('cpu')}
+    except Exception as e:
+        # raising here would make the pool start new workers forever: fail on the first shard instead
+        _offline_models = e
+        return
+    for variant, build_model in (('234', build_model_234), ('1234', build_model_1234)):
         try:
-            response = requests.post(endpoint, json={'data': sentences[0]}).json()
-            response['predictions_34']
-            logging.info('Connection succeded')
-            break
-        except ConnectionError as e:
-            continue
-        except KeyError as e:
-            logging.error(f'Server response in wrong format')
-            logging.error(f'Response was: {response}')
-            logging.error(e, exc_info=True)
-            exit(1)
+            _offline_models[variant] = build_model('cpu')
+        except Exception:
+            _offline_models[variant] = None
+
+
+def _annotate_offline(shard):
+    """
+    Predicts a list of (sentence_id, sentence) pairs in process, returning for each sentence its id, its length and
+    the response the server would give in the compact format.
+    """
+    if isinstance(_offline_models, Exception):
+        raise RuntimeError('build_model_34 failed') from _offline_models
+
+    predictions = pipeline.predict(_offline_models, [sentence for _, sentence in shard])
+    responses = [
+        {
+            f'predictions_{variant}': utils.compact_prediction(prediction) if prediction else prediction
+            for variant, prediction in sentence_predictions.items()
+        }
+        for sentence_predictions in predictions
+    ]
+    # a JSON round trip, as over HTTP, so that the predictions are scored exactly as the ones of the server
+    responses = json.loads(json.dumps(responses))
+    return [(sentence_id, len(sentence['words']), response) for (sentence_id, sentence), response in zip(shard, responses)]
+
+
+def main(
+        test_path: str, endpoint: str, concurrency: int = 1, startup_timeout: float = 100.0,
+        offline: bool = False, processes: int = None, shard_size: int = 64, save_predictions: str = None,
+        predictions_log: str = None, resume: bool = False, score_only: bool = False, slices: str = None
+):
 
+    if not offline and not score_only and not wait_for_server(endpoint, startup_timeout):
+        logging.error(f'Impossible to establish a connection to the server even after {startup_timeout} seconds')
+        logging.error('The server is not booting and, most likely, you have some error in build_model or StudentClass')
+        logging.error('You can find more information inside logs/. Checkout both server.stdout and, most importantly, server.stderr')
+        exit(1)
+
+    labels = {}
+    # the features of the sentences needed by --slices
+    features = {}
     predictions_34 = {}
     predictions_234 = {}
     predictions_1234 = {}
 
-    progress_bar = tqdm(total=len(sentences), desc='Evaluating')
+    # the dataset is streamed, so requests start before the whole file is parsed: the total is counted beforehand
+    progress_bar = tqdm(desc='Evaluating', total=utils.dataset_size(test_path))
+
+    # each thread keeps its own session, so that connections are pooled and kept alive across requests
+    sessions = threading.local()
+    # client-side latency of each request, in seconds
+    latencies = []
 
-    for sentence_id in sentences:
-        sentence = sentences[sentence_id]
+    def annotate(sentence):
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        start = time.perf_counter()
+        # compact responses do not echo the sentence and only contain the non-null roles (gzipped if large enough)
+        response = sessions.session.post(endpoint, json={'data': sentence, 'format': 'compact'})
+        # requests shed by an overloaded server (see async_serve.py) are retried when it says so
+        while response.status_code == 503 and 'Retry-After' in response.headers:
+            time.sleep(float(response.headers['Retry-After']))
+            response = sessions.session.post(endpoint, json={'data': sentence, 'format': 'compact'})
+        latencies.append(time.perf_counter() - start)
+        return response.json()
+
+    def store(sentence_id, length, response):
+        # the predictions are expanded from copies, so that the response is left compact for the predictions log
         try:
-            response = requests.post(endpoint, json={'data': sentence}).json()
-            predictions_34[sentence_id] = response['predictions_34']
-            predictions_34[sentence_id]['roles'] = {int(i): p for i, p in predictions_34[sentence_id]['roles'].items()}
-            if response['predictions_234']:
-                predictions_234[sentence_id] = response['predictions_234']
-                predictions_234[sentence_id]['roles'] = {int(i): p for i, p in predictions_234[sentence_id]['roles'].items()}
-            if response['predictions_1234']:
-                predictions_1234[sentence_id] = response['predictions_1234']
-                predictions_1234[sentence_id]['roles'] = {int(i): p for i, p in predictions_1234[sentence_id]['roles'].items()}
-        except KeyError as e:
+            prediction_34 = utils.expand_prediction(dict(response['predictions_34']), length)
+            prediction_234, prediction_1234 = (
+                utils.expand_prediction(dict(response[key]), length) if response[key] else None
+                for key in ('predictions_234', 'predictions_1234')
+            )
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
             logging.error(f'Server response in wrong format')
             logging.error(f'Response was: {response}')
             logging.error(e, exc_info=True)
             exit(1)
+        predictions_34[sentence_id] = prediction_34
+        if prediction_234:
+            predictions_234[sentence_id] = prediction_234
+        if prediction_1234:
+            predictions_1234[sentence_id] = prediction_1234
         progress_bar.update(1)
 
-    progress_bar.close()
+    def read(sentence_id, sentence, label):
+        labels[sentence_id] = label
+        if slices:
+            features[sentence_id] = {feature: sentence[feature] for feature in FEATURES}
 
-    print('MODEL: ARGUMENT IDENTIFICATION + ARGUMENT CLASSIFICATION')
-    argument_identification_results = utils.evaluate_argument_identification(labels, predictions_34)
-    argument_classification_results = utils.evaluate_argument_classification(labels, predictions_34)
-    print(utils.print_table('argument identification', argument_identification_results))
-    print(utils.print_table('argument classification', argument_classification_results))
+    def score():
+        print_results(labels, predictions_34, predictions_234, predictions_1234)
+        if slices:
+            results = {}
+            for variant, predictions in (('34', predictions_34), ('234', predictions_234), ('1234', predictions_1234)):
+                if predictions:
+                    print(f'MODEL {variant}: SLICES')
+                    print()
+                    results[variant] = slice_scores(features, labels, predictions, utils.VARIANT_TASKS[variant])
+                    print_slices(results[variant], utils.VARIANT_TASKS[variant])
+            with open(slices, 'w') as f:
+                json.dump(results, f, indent=4)
 
-    if predictions_234:
-        print('MODEL: PREDICATE DISAMBIGUATION + ARGUMENT IDENTIFICATION + ARGUMENT CLASSIFICATION')
-        predicate_disambiguation_results = utils.evaluate_predicate_disambiguation(labels, predictions_234)
-        print(utils.print_table('predicate disambiguation', predicate_disambiguation_results))
+    # sentences already recorded in the predictions log are scored from it, without predicting them again
+    logged = PredictionsLog.read(predictions_log) if predictions_log and (resume or score_only) else {}
+    for sentence_id, (length, response) in logged.items():
+        store(sentence_id, length, response)
+    if logged:
+        logging.info(f'{len(logged)} sentences read from {predictions_log}')
 
-        argument_identification_results = utils.evaluate_argument_identification(labels, predictions_234)
-        argument_classification_results = utils.evaluate_argument_classification(labels, predictions_234)
-        print(utils.print_table('argument identification', argument_identification_results))
-        print(utils.print_table('argument classification', argument_classification_results))
+    if score_only:
+        progress_bar.close()
+        for sentence_id, sentence, label in read_dataset(test_path):
+            read(sentence_id, sentence, label)
+        missing = len(set(labels) - set(logged))
+        if missing:
+            logging.warning(f'{missing} sentences are not in {predictions_log}: scoring only the other {len(labels) - missing}')
+            labels = {sentence_id: label for sentence_id, label in labels.items() if sentence_id in logged}
+        score()
+        return
 
-    if predictions_1234:
-        print('MODEL: PREDICATE IDENTIFICATION + PREDICATE DISAMBIGUATION + ARGUMENT IDENTIFICATION + ARGUMENT CLASSIFICATION')
-        predicate_identification_results = utils.evaluate_predicate_identification(labels, predictions_1234)
-        print(utils.print_table('predicate identification', predicate_identification_results))
-        predicate_disambiguation_results = utils.evaluate_predicate_disambiguation(labels, predictions_1234)
-        print(utils.print_table('predicate disambiguation', predicate_disambiguation_results))
+    log = PredictionsLog(predictions_log, append=resume) if predictions_log else None
+
+    def record(sentence_id, length, response):
+        # logged only once store has checked it, so that a malformed response never ends up in the log
+        store(sentence_id, length, response)
+        if log:
+            log.write(sentence_id, length, response)
+
+    def shards():
+        shard = []
+        for sentence_id, sentence, label in read_dataset(test_path):
+            read(sentence_id, sentence, label)
+            if sentence_id in logged:
+                continue
+            shard.append((sentence_id, sentence))
+            if len(shard) == shard_size:
+                yield shard
+                shard = []
+        if shard:
+            yield shard
 
-        argument_identification_results = utils.evaluate_argument_identification(labels, predictions_1234)
-        argument_classification_results = utils.evaluate_argument_classification(labels, predictions_1234)
-        print(utils.print_table('argument identification', argument_identification_results))
-        print(utils.print_table('argument classification', argument_classification_results))
+    start = time.perf_counter()
+    try:
+        if offline:
+            # each process of the pool builds the models once, then predicts shards of shard_size sentences. The dataset
+            # is read here rather than by the pool (as imap would), so that errors reading it stop the evaluation
+            with multiprocessing.Pool(processes, initializer=_init_offline_worker) as pool:
+                # shards submitted but not recorded yet, at most two per process
+                pending = deque()
+                max_pending = 2 * (processes or os.cpu_count())
+                try:
+                    for shard in shards():
+                        pending.append(pool.apply_async(_annotate_offline, (shard,)))
+                        while len(pending) >= max_pending or (pending and pending[0].ready()):
+                            for sentence_id, length, response in pending.popleft().get():
+                                record(sentence_id, length, response)
+                    while pending:
+                        for sentence_id, length, response in pending.popleft().get():
+                            record(sentence_id, length, response)
+                except RuntimeError as e:
+                    logging.error('Evaluation crashed because the models could not be built')
+                    logging.error(e, exc_info=True)
+                    exit(1)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                pending = {}
+                for sentence_id, sentence, label in read_dataset(test_path):
+                    read(sentence_id, sentence, label)
+                    if sentence_id in logged:
+                        continue
+                    future = executor.submit(annotate, sentence)
+                    pending[future] = sentence_id, len(sentence['words'])
+                    if len(pending) >= concurrency:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            record(*pending.pop(future), future.result())
+                for future in as_completed(pending):
+                    record(*pending[future], future.result())
+    finally:
+        # whatever happens, keep what has been predicted so far for --resume
+        if log:
+            log.close()
+
+    elapsed = time.perf_counter() - start
+    progress_bar.close()
+
+    if offline:
+        predicted = len(labels) - len(logged)
+        print(f'{predicted} sentences in {elapsed:.2f}s ({predicted / elapsed:.1f} sentences/s)')
+        print()
+    else:
+        print_latencies(latencies, elapsed)
+    if save_predictions:
+        # e.g. for significance.py
+        with open(save_predictions, 'w') as f:
+            json.dump({'34': predictions_34, '234': predictions_234, '1234': predictions_1234}, f)
+
+    score()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("file", type=str, help='File containing data you want to evaluate upon')
+    parser.add_argument("--concurrency", type=int, default=1, help='Maximum number of requests in flight at the same time')
+    parser.add_argument("--startup-timeout", type=float, default=100.0, help='Seconds to wait for the server to go up')
+    parser.add_argument("--offline", action='store_true', help='Build the models in process instead of querying the server')
+    parser.add_argument("--processes", type=int, default=None, help='Processes used with --offline (default: one per CPU)')
+    parser.add_argument("--shard-size", type=int, default=64, help='Sentences sent at once to each process with --offline')
+    parser.add_argument("--save-predictions", type=str, default=None, help='File where the predictions are saved as JSON')
+    parser.add_argument("--predictions-log", type=str, default=None, help='JSON lines file where the predictions are recorded as they arrive')
+    parser.add_argument("--resume", action='store_true', help='Skip the sentences already recorded in --predictions-log')
+    parser.add_argument("--score-only", action='store_true', help='Score the predictions in --predictions-log, without predicting')
+    parser.add_argument("--slices", type=str, default=None, help='File where the scores on slices of the data (see slices.py) are written as JSON')
     args = parser.parse_args()
 
+    if (args.resume or args.score_only) and not args.predictions_log:
+        parser.error('--resume and --score-only require --predictions-log')
+
     main(
         test_path=args.file,
-        endpoint='http://127.0.0.1:12345'
+        endpoint='http://127.0.0.1:12345',
+        concurrency=args.concurrency,
+        startup_timeout=args.startup_timeout,
+        offline=args.offline,
+        processes=args.processes,
+        shard_size=args.shard_size,
+        save_predictions=args.save_predictions,
+        predictions_log=args.predictions_log,
+        resume=args.resume,
+        score_only=args.score_only,
+        slices=args.slices
     )
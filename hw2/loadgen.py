@@ -0,0 +1,298 @@
+"""
+Open-loop load generator for the server: sentences of a dataset (or the requests recorded in a JSON lines file) are
+sent at a given rate, whether or not the previous requests have been answered, and a latency report is printed:
+
+    python hw2/loadgen.py data/dev.json --qps 20 --duration 60
+    python hw2/loadgen.py data/dev.json --profile ramp --qps 5 --final-qps 100 --duration 120 --output report.json
+    python hw2/loadgen.py requests.jsonl --profile step --qps 10 --step-qps 10 --step-duration 30 --in-process
+
+The rate is constant (--qps), grows linearly from --qps to --final-qps (ramp), or grows by --step-qps every
+--step-duration seconds (step). At most --concurrency requests are in flight: requests due while all the connections are
+busy wait for one. Latency is measured from the time each request was due, not from the time it was sent, so that the
+time spent waiting behind a slow server counts (the correction for coordinated omission); the time from sending to
+answer is reported separately as service time. Percentiles are computed over successful (200) responses.
+
+Recorded requests are JSON lines of request bodies as sent to the server, e.g. {"data": {...}, "format": "compact"},
+with an optional "path" (by default, /batch for lists of sentences and / otherwise). Any other file is read as a dataset
+by utils.iter_dataset.
+
+With --in-process, app.py is served by a werkzeug server in a thread of the load generator, instead of querying
+--endpoint: this needs no container, but the server competes with the load generator for the interpreter.
+"""
+import logging
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+import argparse
+import json
+import math
+import requests
+import threading
+import time
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.exceptions import ConnectionError, RequestException, Timeout
+from typing import Dict, List, Tuple
+
+import utils
+from evaluate import wait_for_server
+
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def load_requests(path: str, response_format: str) -> List[Tuple[str, bytes]]:
+    """
+    Returns the (path, body) of each request, with the body already encoded so that encoding is not measured.
+    """
+    if path.endswith('.jsonl'):
+        with open(path) as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        if lines and 'data' in lines[0]:
+            return [
+                (line.pop('path', '/batch' if isinstance(line['data'], list) else '/'), json.dumps(line).encode('utf-8'))
+                for line in lines
+            ]
+    return [
+        ('/', json.dumps({'data': sentence, 'format': response_format}).encode('utf-8'))
+        for _, sentence, _ in utils.iter_dataset(path)
+    ]
+
+
+def schedule(
+        profile: str, qps: float, duration: float, final_qps: float = None, step_qps: float = None,
+        step_duration: float = None, resolution: float = 0.001
+) -> np.ndarray:
+    """
+    Returns the times (in seconds from the start) when the requests of a run of duration seconds are due, i.e. the
+    times when the integral of the rate of the profile reaches each integer.
+    """
+    grid = np.linspace(0, duration, int(math.ceil(duration / resolution)) + 1)
+    if profile == 'ramp':
+        rates = qps + (final_qps - qps) * grid / duration
+    elif profile == 'step':
+        rates = qps + step_qps * np.floor(grid / step_duration)
+    else:
+        rates = np.full(len(grid), float(qps))
+    # cumulative number of requests due at each point of the grid (trapezoidal rule)
+    due = np.concatenate([[0], np.cumsum((rates[1:] + rates[:-1]) / 2 * np.diff(grid))])
+    return np.interp(np.arange(math.floor(due[-1] + 1e-9)), due, grid)
+
+
+def run(endpoint: str, requests_: List[Tuple[str, bytes]], times: np.ndarray, concurrency: int, timeout: float):
+    """
+    Sends requests_ (cycling through them) at times, returning for each request the time it was sent and the time it
+    was answered (NaN for the requests never sent), and its status: the HTTP status code as a string, 'timeout',
+    'connection_error', 'error' for any other failure, None for the requests never sent.
+    """
+    sent = np.full(len(times), np.nan)
+    answered = np.full(len(times), np.nan)
+    statuses = np.full(len(times), None, dtype=object)
+    endpoint = endpoint.rstrip('/')
+
+    # each thread keeps its own session, so that connections are pooled and kept alive across requests
+    sessions = threading.local()
+
+    def send(i, start):
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        path, body = requests_[i % len(requests_)]
+        sent[i] = time.perf_counter() - start
+        try:
+            response = sessions.session.post(endpoint + path, data=body, headers={'Content-Type': 'application/json'}, timeout=timeout)
+            statuses[i] = str(response.status_code)
+        except Timeout:
+            statuses[i] = 'timeout'
+        except ConnectionError:
+            statuses[i] = 'connection_error'
+        except RequestException:
+            statuses[i] = 'error'
+        except Exception as e:
+            # a failure of the load generator itself still counts the request, rather than losing it with the future
+            logging.error(e, exc_info=True)
+            statuses[i] = 'error'
+        answered[i] = time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = time.perf_counter()
+        try:
+            for i, due in enumerate(times):
+                delay = start + due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                # requests are queued as soon as they are due, even if all the threads are busy (open loop)
+                executor.submit(send, i, start)
+        except KeyboardInterrupt:
+            logging.warning(f'Interrupted: waiting for the {i} requests already due')
+            times = times[:i]
+
+    return sent[:len(times)], answered[:len(times)], statuses[:len(times)]
+
+
+def latency_percentiles(latencies: np.ndarray) -> Dict[str, float]:
+    """
+    Percentiles, mean and maximum of latencies (in seconds), in milliseconds.
+    """
+    if len(latencies) == 0:
+        return {}
+    values = np.percentile(latencies, PERCENTILES) * 1000
+    summary = {f'p{percentile:g}': float(value) for percentile, value in zip(PERCENTILES, values)}
+    summary['mean'] = float(latencies.mean() * 1000)
+    summary['max'] = float(latencies.max() * 1000)
+    return summary
+
+
+def summarize(times: np.ndarray, sent: np.ndarray, answered: np.ndarray, statuses: np.ndarray, window: float) -> Dict:
+    completed = np.array([status is not None for status in statuses], dtype=bool)
+    succeeded = statuses == '200'
+    statuses_, counts = np.unique(statuses[completed].astype(str), return_counts=True)
+    elapsed = float(np.nanmax(answered)) if completed.any() else 0.0
+    offered_duration = float(times[-1] - times[0]) if len(times) > 1 else 0.0
+
+    report = {
+        'requests': len(times),
+        'completed': int(completed.sum()),
+        'elapsed': elapsed,
+        'offered_qps': (len(times) - 1) / offered_duration if offered_duration else None,
+        'throughput': float(succeeded.sum() / elapsed) if elapsed else None,
+        'error_rate': float(1 - succeeded.sum() / completed.sum()) if completed.any() else None,
+        'statuses': dict(zip(statuses_.tolist(), counts.tolist())),
+        'latency': latency_percentiles(answered[succeeded] - times[succeeded]),
+        'service_time': latency_percentiles(answered[succeeded] - sent[succeeded]),
+        'windows': [],
+    }
+
+    # the requests due in each window, to follow the latency as the rate changes
+    windows = (times // window).astype(np.int64)
+    for w in np.unique(windows):
+        in_window = windows == w
+        report['windows'].append({
+            'start': float(w * window),
+            'offered_qps': float(in_window.sum() / window),
+            'error_rate': float(1 - (succeeded & in_window).sum() / (completed & in_window).sum()) if (completed & in_window).any() else None,
+            'latency': latency_percentiles(answered[succeeded & in_window] - times[succeeded & in_window]),
+        })
+    return report
+
+
+def print_report(report: Dict):
+    offered = f'{report["offered_qps"]:.1f}' if report['offered_qps'] else '-'
+    print(f'Requests      = {report["requests"]} ({report["completed"]} completed, {offered} per second offered)')
+    if report['throughput'] is not None:
+        print(f'Throughput    = {report["throughput"]:.1f} successful requests per second')
+    if report['error_rate'] is not None:
+        print(f'Error rate    = {report["error_rate"]:.2%} {report["statuses"]}')
+    print()
+
+    columns = [f'p{percentile:g}' for percentile in PERCENTILES] + ['max']
+    print(f'{"(ms)":<14}' + ''.join(f'{column:>10}' for column in columns))
+    for name, label in (('latency', 'latency'), ('service_time', 'service time')):
+        if report[name]:
+            print(f'{label:<14}' + ''.join(f'{report[name][column]:>10.1f}' for column in columns))
+    print()
+
+    if len(report['windows']) > 1:
+        print(f'{"window (s)":<14}{"offered":>10}{"errors":>10}{"p50":>10}{"p99":>10}')
+        for window in report['windows']:
+            latency = window['latency']
+            errors = f'{window["error_rate"]:.2%}' if window['error_rate'] is not None else '-'
+            p50, p99 = (f'{latency[p]:.1f}' if latency else '-' for p in ('p50', 'p99'))
+            print(f'{window["start"]:<14g}{window["offered_qps"]:>10.1f}{errors:>10}{p50:>10}{p99:>10}')
+
+
+def start_in_process_server():
+    """
+    Serves app.py from a thread of this process on a free port, returning the server and its endpoint.
+    """
+    from werkzeug.serving import make_server
+    from app import app
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def main(
+        path: str, endpoint: str, in_process: bool, profile: str, qps: float, final_qps: float, step_qps: float,
+        step_duration: float, duration: float, concurrency: int, timeout: float, response_format: str, window: float,
+        startup_timeout: float, output: str
+):
+
+    requests_ = load_requests(path, response_format)
+    if not requests_:
+        logging.error(f'No requests found in {path}')
+        exit(1)
+    times = schedule(profile, qps, duration, final_qps, step_qps, step_duration)
+
+    server = None
+    if in_process:
+        server, endpoint = start_in_process_server()
+    elif not wait_for_server(endpoint, startup_timeout):
+        logging.error(f'Impossible to establish a connection to {endpoint} even after {startup_timeout} seconds')
+        exit(1)
+
+    logging.info(f'Sending {len(times)} requests ({len(requests_)} distinct) to {endpoint} in {duration} seconds')
+    try:
+        sent, answered, statuses = run(endpoint, requests_, times, concurrency, timeout)
+    finally:
+        if server:
+            server.shutdown()
+
+    report = summarize(times[:len(statuses)], sent, answered, statuses, window)
+    print_report(report)
+
+    if output:
+        report['config'] = {
+            'path': path, 'endpoint': 'in-process' if in_process else endpoint, 'profile': profile, 'qps': qps,
+            'final_qps': final_qps, 'step_qps': step_qps, 'step_duration': step_duration, 'duration': duration,
+            'concurrency': concurrency, 'timeout': timeout, 'format': response_format,
+        }
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send requests to the server at a given rate and report their latency')
+    parser.add_argument("file", type=str, help='Dataset, or JSON lines file of recorded requests')
+    parser.add_argument("--endpoint", type=str, default='http://127.0.0.1:12345', help='Server to query')
+    parser.add_argument("--in-process", action='store_true', help='Serve app.py from this process instead of querying --endpoint')
+    parser.add_argument("--profile", type=str, default='constant', choices=['constant', 'ramp', 'step'], help='How the rate changes over time')
+    parser.add_argument("--qps", type=float, default=10.0, help='Requests per second (at the start, for ramp and step)')
+    parser.add_argument("--final-qps", type=float, default=None, help='Requests per second at the end of a ramp')
+    parser.add_argument("--step-qps", type=float, default=None, help='Requests per second added at each step')
+    parser.add_argument("--step-duration", type=float, default=10.0, help='Seconds between steps')
+    parser.add_argument("--duration", type=float, default=60.0, help='Seconds during which requests are sent')
+    parser.add_argument("--concurrency", type=int, default=64, help='Maximum number of requests in flight at the same time')
+    parser.add_argument("--timeout", type=float, default=30.0, help='Seconds after which a request is counted as failed')
+    parser.add_argument("--format", type=str, default='compact', choices=['compact', 'full'], help='Response format requested for dataset sentences')
+    parser.add_argument("--window", type=float, default=10.0, help='Seconds of the windows in which the latency is also reported')
+    parser.add_argument("--startup-timeout", type=float, default=100.0, help='Seconds to wait for the server to go up')
+    parser.add_argument("--output", type=str, default=None, help='File where the report is written as JSON')
+    args = parser.parse_args()
+
+    if args.qps <= 0:
+        parser.error('--qps must be positive')
+    if args.profile == 'ramp' and (args.final_qps is None or args.final_qps <= 0):
+        parser.error('--profile ramp requires a positive --final-qps')
+    if args.profile == 'step' and (args.step_qps is None or args.step_qps < 0):
+        parser.error('--profile step requires a non-negative --step-qps')
+
+    main(
+        path=args.file,
+        endpoint=args.endpoint,
+        in_process=args.in_process,
+        profile=args.profile,
+        qps=args.qps,
+        final_qps=args.final_qps,
+        step_qps=args.step_qps,
+        step_duration=args.step_duration,
+        duration=args.duration,
+        concurrency=args.concurrency,
+        timeout=args.timeout,
+        response_format=args.format,
+        window=args.window,
+        startup_timeout=args.startup_timeout,
+        output=args.output
+    )
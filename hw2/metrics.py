@@ -0,0 +1,133 @@
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+
+import numpy as np
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Metrics:
+    """
+    Thread-safe counters and latency summaries, rendered in the Prometheus text format. Latency quantiles are computed
+    over the last window observations of each series, while counts and sums cover the whole lifetime of the process.
+    """
+
+    def __init__(self, prefix: str = 'hw2', window: int = 10000):
+        self.prefix = prefix
+        self.window = window
+        self._counters = defaultdict(int)
+        self._latencies = defaultdict(lambda: [0, 0.0, deque(maxlen=self.window)])
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, **labels):
+        with self._lock:
+            self._counters[name, tuple(sorted(labels.items()))] += 1
+
+    def observe(self, name: str, seconds: float, **labels):
+        with self._lock:
+            latency = self._latencies[name, tuple(sorted(labels.items()))]
+            latency[0] += 1
+            latency[1] += seconds
+            latency[2].append(seconds)
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        """
+        Observes the duration of the block under name and, if the block raises, also counts an error with its labels
+        (e.g. errors{stage="model_34"} for a failing model).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.increment('errors', **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self, gauges=None) -> str:
+        """
+        Renders every counter and latency summary, plus the given {name: value} gauges.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            latencies = {key: (count, total, np.array(samples)) for key, (count, total, samples) in self._latencies.items()}
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f'# TYPE {self.prefix}_{name}_total counter')
+            for (series, labels), value in sorted(counters.items()):
+                if series == name:
+                    lines.append(f'{self.prefix}_{name}_total{_format_labels(labels)} {value}')
+
+        for name in sorted({name for name, _ in latencies}):
+            lines.append(f'# TYPE {self.prefix}_{name}_seconds summary')
+            for (series, labels), (count, total, samples) in sorted(latencies.items(), key=lambda item: item[0]):
+                if series != name:
+                    continue
+                values = np.quantile(samples, QUANTILES) if len(samples) else [float('nan')] * len(QUANTILES)
+                for quantile, value in zip(QUANTILES, values):
+                    lines.append(f'{self.prefix}_{name}_seconds{_format_labels(labels + (("quantile", quantile),))} {value:.6f}')
+                lines.append(f'{self.prefix}_{name}_seconds_sum{_format_labels(labels)} {total:.6f}')
+                lines.append(f'{self.prefix}_{name}_seconds_count{_format_labels(labels)} {count}')
+
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f'# TYPE {self.prefix}_{name} gauge')
+            lines.append(f'{self.prefix}_{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class SlowRequestProfiler:
+    """
+    Profiles a random sample_rate fraction of the requests with cProfile, dumping in directory the profile of those
+    that take longer than slow_ms milliseconds (inspect them with python -m pstats). Only the thread handling the
+    request is profiled: models running on other threads (e.g. with HW2_PARALLEL_MODELS) are not.
+    """
+
+    def __init__(self, sample_rate: float, slow_ms: float, directory: str):
+        self.sample_rate = sample_rate
+        self.slow = slow_ms / 1000
+        self.directory = directory
+
+    @contextmanager
+    def profile(self, name: str):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another request is being profiled and the interpreter does not support concurrent profilers
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.slow:
+                path = os.path.join(self.directory, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}-{int(elapsed * 1000)}ms-{os.getpid()}-{threading.get_ident()}.prof')
+                try:
+                    os.makedirs(self.directory, exist_ok=True)
+                    profiler.dump_stats(path)
+                except OSError as e:
+                    # never fail a request because its profile could not be saved
+                    logging.warning(f'Could not save the profile of a slow request to {path}: {e}')
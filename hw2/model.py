@@ -3,6 +3,10 @@ from typing import List
 
 class Model:
 
+    # set it to True if predict always returns the same prediction for the same input sentence:
+    # only the predictions of deterministic models can be cached by the server
+    deterministic = False
+
     def predict(self, sentence):
         
         """
@@ -63,3 +67,34 @@ class Model:
                     }
         """
         raise NotImplementedError
+
+    def predict_batch(self, sentences):
+
+        """
+        Predicts a list of sentences at once. The default implementation simply calls predict on each sentence;
+        models that can process several sentences together (e.g. padding them in a single tensor) should override it.
+
+        Args:
+            sentences: a list of dictionaries, each one in the format accepted by predict.
+
+        Returns:
+            A list with one prediction (in the format returned by predict) for each input sentence, in the same order.
+        """
+        return [self.predict(sentence) for sentence in sentences]
+
+    def predict_batch_with_contexts(self, sentences, contexts):
+
+        """
+        Same as predict_batch, but also receives, for each sentence, a pipeline.SentenceContext that is shared with the
+        models of the other variants running on the same sentence, so that common preprocessing (e.g. vocabulary
+        lookups with pipeline.lookup_batch, or SentenceContext.tree) is computed only once. The default implementation
+        ignores the contexts.
+
+        Args:
+            sentences: a list of dictionaries, each one in the format accepted by predict.
+            contexts: a list with the SentenceContext of each sentence.
+
+        Returns:
+            A list with one prediction (in the format returned by predict) for each input sentence, in the same order.
+        """
+        return self.predict_batch(sentences)
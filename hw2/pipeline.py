@@ -0,0 +1,139 @@
+import numpy as np
+from contextlib import nullcontext
+from itertools import chain
+
+
+VARIANTS = ('34', '234', '1234')
+SHARED_FIELDS = ('words', 'lemmas', 'pos_tags', 'dependency_heads', 'dependency_relations')
+_STAGES = {variant: f'model_{variant}' for variant in VARIANTS}
+_MISSING = object()
+
+
+class SentenceContext:
+    """
+    Per-sentence work shared by the models of all the variants. Every value is computed the first time it is requested
+    and then reused, even by models running concurrently on other threads.
+    """
+
+    __slots__ = ('sentence', '_cache')
+
+    def __init__(self, sentence):
+        self.sentence = sentence
+        self._cache = {}
+
+    def get(self, key, compute, *args):
+        """
+        Returns the value stored under key, computing it with compute(*args) if this is the first request.
+        """
+        value = self._cache.get(key, _MISSING)
+        if value is _MISSING:
+            # setdefault is atomic, so models computing the same value concurrently all get the one stored first
+            value = self._cache.setdefault(key, compute(*args))
+        return value
+
+    @property
+    def heads(self):
+        return self.get('heads', lambda: [int(head) for head in self.sentence['dependency_heads']])
+
+    @property
+    def tree(self):
+        """
+        The stud.tree.DependencyTree of the sentence, with LCAs, distances and paths between tokens.
+        """
+        from stud.tree import dependency_tree
+        return self.get('tree', lambda: dependency_tree(self.heads))
+
+
+def lookup_batch(contexts, field, vocabulary):
+    """
+    Returns a numpy array with the ids that vocabulary (a dictionary, which must outlive the contexts) assigns to the
+    tokens of field in all the sentences of contexts, one sentence after the other. The ids of each sentence are cached
+    in its context, and the sentences not looked up yet by another model are looked up together, in a single pass.
+    """
+    key = ('lookup', field, id(vocabulary))
+    missing = [context for context in contexts if key not in context._cache]
+    if missing:
+        tokens = chain.from_iterable(context.sentence[field] for context in missing)
+        ids = np.fromiter(map(vocabulary.__getitem__, tokens), dtype=np.int64)
+        offsets = np.cumsum([len(context.sentence[field]) for context in missing[:-1]], dtype=np.int64)
+        for context, sentence_ids in zip(missing, np.split(ids, offsets)):
+            context._cache.setdefault(key, sentence_ids)
+        if len(missing) == len(contexts):
+            return ids
+    return np.concatenate([context._cache[key] for context in contexts])
+
+
+def prepare_data(data):
+    shared = {field: data[field] for field in SHARED_FIELDS}
+
+    data_34 = data
+    data_234 = dict(shared, predicates=[1 if p != '_' else 0 for p in data['predicates']])
+    data_1234 = shared
+
+    return data_34, data_234, data_1234
+
+
+def predict(models, sentences, executor=None, cache=None, metrics=None):
+    """
+    Runs the model of each variant on sentences.
+
+    Args:
+        models: a dictionary mapping each of VARIANTS to its Model (None if it is not available).
+        sentences: a list of sentences, in the format of the data_34 input.
+        executor: if given, the models of the different variants are run concurrently on it.
+        cache: if given, a PredictionCache used for the models that declare themselves deterministic.
+        metrics: if given, a metrics.Metrics where the latency of the preprocessing and of each model is recorded.
+
+    Returns:
+        A list with, for each sentence, a dictionary mapping each variant to its prediction (None if the model is not
+        available).
+    """
+    if not sentences:
+        return []
+    timer = metrics.time if metrics else _no_timer
+
+    with timer('stage_latency', stage='prepare_data'):
+        inputs = zip(*map(prepare_data, sentences))
+        contexts = list(map(SentenceContext, sentences))
+
+    def run(variant, batch):
+        model = models[variant]
+        if not model:
+            return [None] * len(batch)
+        batch = list(batch)
+        if cache is None or not model.deterministic:
+            with timer('stage_latency', stage=_STAGES[variant]):
+                return _predict_batch(variant, model, batch, contexts)
+
+        keys = [cache.key(variant, data) for data in batch]
+        predictions = [cache.get(key) for key in keys]
+        missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+        if missing:
+            with timer('stage_latency', stage=_STAGES[variant]):
+                computed = _predict_batch(variant, model, [batch[i] for i in missing], [contexts[i] for i in missing])
+            for i, prediction in zip(missing, computed):
+                predictions[i] = prediction
+                cache.put(keys[i], prediction)
+        return predictions
+
+    if executor:
+        futures = [executor.submit(run, variant, batch) for variant, batch in zip(VARIANTS, inputs)]
+        results = [future.result() for future in futures]
+    else:
+        results = [run(variant, batch) for variant, batch in zip(VARIANTS, inputs)]
+
+    return [dict(zip(VARIANTS, sentence_predictions)) for sentence_predictions in zip(*results)]
+
+
+_NO_TIMER = nullcontext()
+
+
+def _no_timer(name, **labels):
+    return _NO_TIMER
+
+
+def _predict_batch(variant, model, batch, contexts):
+    predictions = model.predict_batch_with_contexts(batch, contexts)
+    if len(predictions) != len(batch):
+        raise ValueError(f'model_{variant} returned {len(predictions)} predictions for {len(batch)} sentences')
+    return predictions
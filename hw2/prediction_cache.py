@@ -0,0 +1,57 @@
+import hashlib
+import json
+import threading
+
+from collections import OrderedDict
+
+
+class PredictionCache:
+    """
+    A thread-safe, content-addressed LRU cache of model predictions. Entries are keyed on the variant and on a
+    canonical hash of the model input, so that equal sentences hit the same entry regardless of their key order.
+    Cached predictions are shared among all the requests that hit them, hence they must not be modified.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(variant: str, data) -> str:
+        encoded = json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        return f'{variant}:{hashlib.sha1(encoded).hexdigest()}'
+
+    def get(self, key: str):
+        """
+        Returns the prediction stored under key, or None if there is none.
+        """
+        with self._lock:
+            prediction = self._entries.get(key)
+            if prediction is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return prediction
+
+    def put(self, key: str, prediction):
+        with self._lock:
+            self._entries[key] = prediction
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
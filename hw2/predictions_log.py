@@ -0,0 +1,93 @@
+import json
+import logging
+
+from typing import Dict, Tuple
+
+
+VARIANTS = ('1234', '234', '34')
+
+
+class PredictionsLog:
+    """
+    An append-only JSON lines log of the (compact) server responses, one line per sentence and variant:
+
+        {"sentence_id": 3, "variant": "34", "length": 24, "prediction": {"roles": {"9": {"0": "Agent"}}}}
+
+    The line of model_34 (which is mandatory) is written last, so that a sentence is recorded only if its model_34
+    line is. Lines are buffered and flushed every flush_every sentences, and when the log is closed.
+    With append, new lines are added to the existing log (if any), otherwise the log is overwritten.
+    """
+
+    def __init__(self, path: str, append: bool = False, flush_every: int = 100):
+        self.path = path
+        self.flush_every = flush_every
+        self._file = open(path, 'a' if append else 'w')
+        self._buffer = []
+        self._buffered_sentences = 0
+
+        # terminate a line truncated by a crash, so that the new lines can still be read
+        if self._file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, 2)
+                if f.read(1) != b'\n':
+                    self._buffer.append('\n')
+
+    def write(self, sentence_id: int, length: int, response: Dict):
+        for variant in VARIANTS:
+            prediction = response.get(f'predictions_{variant}')
+            if prediction:
+                self._buffer.append(json.dumps({
+                    'sentence_id': sentence_id, 'variant': variant, 'length': length, 'prediction': prediction
+                }) + '\n')
+        self._buffered_sentences += 1
+        if self._buffered_sentences >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self._file.write(''.join(self._buffer))
+        self._file.flush()
+        self._buffer = []
+        self._buffered_sentences = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def read(path: str) -> Dict[int, Tuple[int, Dict]]:
+        """
+        Reads the sentences recorded in the log at path, returning for each sentence id its length and its response.
+        Malformed lines (i.e. writes interrupted by a crash) and predictions without roles are ignored, as is any
+        sentence without model_34.
+        """
+        records = {}
+        sentences = {}
+        try:
+            with open(path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return sentences
+
+        for i, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+                sentence_id, variant, length, prediction = (
+                    record['sentence_id'], record['variant'], record['length'], record['prediction'])
+                if variant not in VARIANTS or not isinstance(prediction.get('roles'), dict):
+                    raise ValueError(f'invalid record: {line.strip()}')
+            except (ValueError, KeyError, TypeError, AttributeError):
+                # lines truncated by a crash are terminated when the log is reopened; records that could not be scored
+                # are skipped as well, so that their sentences are predicted again
+                logging.warning(f'Ignoring the malformed line {i + 1} of {path}')
+                continue
+            response = records.setdefault(sentence_id, {f'predictions_{variant}': None for variant in VARIANTS})
+            response[f'predictions_{variant}'] = prediction
+            if variant == '34':
+                sentences[sentence_id] = length, response
+        return sentences
@@ -0,0 +1,127 @@
+"""
+Pre-forked server for app.py: the models are built once in the parent process, which then forks the workers that
+serve the requests, so that all the workers share the memory pages of the models copy-on-write.
+
+    python hw2/serve.py --workers 4 --host 0.0.0.0 --port 12345
+
+On SIGTERM (or SIGINT), workers stop accepting new connections, finish the requests they are serving and exit; workers
+still running after --graceful-timeout seconds are killed. Workers that die unexpectedly are replaced.
+Note that caches and statistics (e.g. /cache) are kept by each worker separately.
+"""
+import logging
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+
+import argparse
+import gc
+import os
+import signal
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+
+def run_worker(server):
+    # the parent takes care of SIGINT (e.g. ctrl-c) and forwards it as SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # shutdown blocks until serve_forever returns, so it must be called from another thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+
+    # let server_close wait for the requests still being served by other threads (if any)
+    server.daemon_threads = False
+    server.block_on_close = True
+
+    try:
+        server.serve_forever()
+        server.server_close()
+    except Exception as e:
+        logging.error(e, exc_info=True)
+        os._exit(1)
+    os._exit(0)
+
+
+def fork_worker(server):
+    pid = os.fork()
+    if pid == 0:
+        run_worker(server)
+    return pid
+
+
+def main(host: str, port: int, workers: int, threaded: bool, graceful_timeout: float):
+
+    # importing app builds the models
+    from app import app, warmup_thread
+
+    # with lazy loading, let the warm-up build the models in the parent, so that the workers share them
+    if warmup_thread:
+        warmup_thread.join()
+
+    server = make_server(host, port, app, threaded=threaded)
+    # all the workers wait on the same listening socket: the ones that lose the race for a connection must not block
+    # in accept, or they would not notice a shutdown
+    server.socket.setblocking(False)
+
+    # move every object built so far out of the tracked generations, so that garbage collections in the workers do
+    # not touch (and thus copy) their pages
+    gc.freeze()
+
+    children = set()
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        children.add(fork_worker(server))
+    logging.info(f'Serving on {host}:{port} with {workers} workers: {sorted(children)}')
+
+    while not stopping.is_set():
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid and pid in children:
+            children.remove(pid)
+            if not stopping.is_set():
+                logging.warning(f'Worker {pid} exited with status {status}, starting a new one')
+                children.add(fork_worker(server))
+        stopping.wait(0.5)
+
+    logging.info('Shutting down: waiting for the workers to finish their requests')
+    for pid in children:
+        os.kill(pid, signal.SIGTERM)
+
+    deadline = time.monotonic() + graceful_timeout
+    while children and time.monotonic() < deadline:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        children.discard(pid)
+        time.sleep(0.05)
+
+    for pid in children:
+        logging.warning(f'Worker {pid} did not stop in {graceful_timeout} seconds, killing it')
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve app.py with pre-forked worker processes')
+    parser.add_argument("--host", type=str, default=os.environ.get('HW2_HOST', '0.0.0.0'), help='Address to bind')
+    parser.add_argument("--port", type=int, default=int(os.environ.get('HW2_PORT', 12345)), help='Port to bind')
+    parser.add_argument("--workers", type=int, default=int(os.environ.get('HW2_WORKERS', os.cpu_count())), help='Number of worker processes')
+    parser.add_argument("--threaded", action='store_true', help='Serve the requests of each worker on multiple threads')
+    parser.add_argument("--graceful-timeout", type=float, default=30.0, help='Seconds given to the workers to finish their requests on shutdown')
+    args = parser.parse_args()
+
+    main(
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        threaded=args.threaded,
+        graceful_timeout=args.graceful_timeout
+    )
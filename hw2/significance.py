@@ -0,0 +1,180 @@
+"""
+Paired bootstrap significance test between the predictions of two models (saved with evaluate.py --save-predictions)
+on the same dataset:
+
+    python hw2/significance.py data/dev.json predictions_a.json predictions_b.json --variant 34
+
+For each task, prints the F1 score of both models with its confidence interval, the confidence interval of their
+difference and the p-value of the difference being due to chance. With a single predictions file, only the confidence
+intervals of its scores are reported.
+
+Sentences are resampled by drawing, in chunks, a matrix of how many times each sentence appears in each resample, so
+that the counts of all the resamples of a chunk are computed with a single matrix product with the per-sentence counts.
+"""
+import logging
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+import argparse
+import json
+
+import numpy as np
+from typing import Dict, List
+
+import utils
+
+
+# maximum size of the matrix of resampling weights of a chunk (resamples x sentences)
+CHUNK_ENTRIES = 1 << 22
+
+
+def f1_scores(counts: np.ndarray) -> np.ndarray:
+    """
+    F1 scores from an array of (true positives, false positives, false negatives) counts on its last axis.
+    """
+    true_positives, false_positives, false_negatives = counts[..., 0], counts[..., 1], counts[..., 2]
+    denominator = 2 * true_positives + false_positives + false_negatives
+    return np.divide(2 * true_positives, denominator, out=np.zeros(denominator.shape), where=denominator > 0)
+
+
+def resample_counts(counts: np.ndarray, resamples: int, seed: int = 0) -> np.ndarray:
+    """
+    Returns the summed counts of resamples bootstrap resamples of the rows of counts, a (sentences, k) array, as a
+    (resamples, k) array.
+    """
+    rng = np.random.default_rng(seed)
+    sentences = len(counts)
+    chunk_size = max(1, min(resamples, CHUNK_ENTRIES // max(sentences, 1)))
+    counts = counts.astype(np.float64)
+
+    results = []
+    for start in range(0, resamples, chunk_size):
+        size = min(chunk_size, resamples - start)
+        # the weights of each resample are the occurrences of each sentence among sentences uniform draws, counted for
+        # all the resamples of the chunk at once by offsetting the draws of resample i by i * sentences
+        draws = rng.integers(sentences, size=(size, sentences))
+        draws += np.arange(size)[:, None] * sentences
+        weights = np.bincount(draws.ravel(), minlength=size * sentences).reshape(size, sentences)
+        results.append(weights @ counts)
+    return np.concatenate(results).round().astype(np.int64)
+
+
+def paired_bootstrap(
+        counts_a: Dict[str, np.ndarray], counts_b: Dict[str, np.ndarray] = None,
+        resamples: int = 10000, confidence: float = 0.95, seed: int = 0
+) -> Dict[str, Dict]:
+    """
+    Runs a paired bootstrap on the per-sentence counts of one or two models (as returned by utils.count_per_sentence
+    on the same sentences), using the same resamples for all the tasks and both models.
+
+    Returns:
+        A dictionary mapping each task to the F1 score and confidence interval of each model and, with two models, to
+        the difference of their F1 scores (b - a), its confidence interval and its two-sided p-value.
+    """
+    tasks = list(counts_a)
+    models = [counts_a] if counts_b is None else [counts_a, counts_b]
+    # (sentences, models * tasks * 3), so that a single matrix product resamples everything
+    stacked = np.concatenate([model[task] for model in models for task in tasks], axis=1)
+    resampled = resample_counts(stacked, resamples, seed).reshape(resamples, len(models), len(tasks), 3)
+    observed = stacked.sum(axis=0).reshape(len(models), len(tasks), 3)
+
+    scores, resampled_scores = f1_scores(observed), f1_scores(resampled)
+    bounds = [100 * (1 - confidence) / 2, 100 * (1 + confidence) / 2]
+
+    results = {}
+    for t, task in enumerate(tasks):
+        result = {}
+        for m, name in enumerate(['a', 'b'][:len(models)]):
+            result[name] = {
+                'f1': float(scores[m, t]),
+                'interval': np.percentile(resampled_scores[:, m, t], bounds).tolist(),
+            }
+        if counts_b is not None:
+            difference = scores[1, t] - scores[0, t]
+            differences = resampled_scores[:, 1, t] - resampled_scores[:, 0, t]
+            # the resampled differences, centered on 0, approximate the distribution of the difference under the null
+            # hypothesis: how often is it at least as extreme as the observed one?
+            p_value = (np.count_nonzero(np.abs(differences - difference) >= abs(difference)) + 1) / (resamples + 1)
+            result['difference'] = {
+                'f1': float(difference),
+                'interval': np.percentile(differences, bounds).tolist(),
+                'p_value': float(p_value),
+            }
+        results[task] = result
+    return results
+
+
+def load_predictions(path: str, variant: str) -> Dict:
+    """
+    Reads the predictions of variant from a file written by evaluate.py --save-predictions.
+    """
+    with open(path) as f:
+        predictions = json.load(f)[variant]
+    return {
+        int(sentence_id): dict(prediction, roles={int(i): roles for i, roles in prediction['roles'].items()})
+        for sentence_id, prediction in predictions.items()
+    }
+
+
+def print_report(results: Dict[str, Dict], confidence: float):
+    level = f'{confidence:.0%}'
+    for task, result in results.items():
+        print(task.upper().replace('_', ' '))
+        for name in ('a', 'b'):
+            if name in result:
+                low, high = result[name]['interval']
+                print(f'    F1 {name}          = {result[name]["f1"]:.4f}  ({level} CI {low:.4f} - {high:.4f})')
+        if 'difference' in result:
+            difference = result['difference']
+            low, high = difference['interval']
+            print(f'    F1 b - a      = {difference["f1"]:+.4f}  ({level} CI {low:+.4f} - {high:+.4f})')
+            print(f'    p-value       = {difference["p_value"]:.4f}')
+        print()
+
+
+def main(
+        test_path: str, predictions_paths: List[str], variant: str, resamples: int, confidence: float, seed: int,
+        output: str
+):
+
+    labels = {sentence_id: label for sentence_id, _, label in utils.iter_dataset(test_path)}
+    predictions = [load_predictions(path, variant) for path in predictions_paths]
+
+    missing = [len(set(labels) - set(model_predictions)) for model_predictions in predictions]
+    if any(missing):
+        logging.error(f'The predictions do not cover all the sentences of {test_path} (missing: {missing})')
+        exit(1)
+
+    tasks = utils.VARIANT_TASKS[variant]
+    counts = [utils.count_per_sentence(labels, model_predictions, tasks)[1] for model_predictions in predictions]
+    results = paired_bootstrap(*counts, resamples=resamples, confidence=confidence, seed=seed)
+
+    print_report(results, confidence)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Paired bootstrap test between the predictions of two models')
+    parser.add_argument("file", type=str, help='File containing the gold labels')
+    parser.add_argument("predictions", type=str, nargs='+', help='One or two files written by evaluate.py --save-predictions')
+    parser.add_argument("--variant", type=str, default='34', choices=list(utils.VARIANT_TASKS), help='Variant to compare')
+    parser.add_argument("--resamples", type=int, default=10000, help='Number of bootstrap resamples')
+    parser.add_argument("--confidence", type=float, default=0.95, help='Level of the confidence intervals')
+    parser.add_argument("--seed", type=int, default=0, help='Seed of the resampling')
+    parser.add_argument("--output", type=str, default=None, help='File where the results are written as JSON')
+    args = parser.parse_args()
+
+    if len(args.predictions) > 2:
+        parser.error('at most two predictions files can be compared')
+
+    main(
+        test_path=args.file,
+        predictions_paths=args.predictions,
+        variant=args.variant,
+        resamples=args.resamples,
+        confidence=args.confidence,
+        seed=args.seed,
+        output=args.output
+    )
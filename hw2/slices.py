@@ -0,0 +1,326 @@
+"""
+Error analysis of the predictions of a model: the scores of its tasks on slices of the data, i.e.
+    - role: the gold role of the arguments (the predicted one for false positives), argument tasks only;
+    - predicate_pos: the POS tag of the predicate (of the token, for predicate tasks);
+    - argument_relation: the dependency relation of the argument, argument tasks only;
+    - length: the length of the sentence, in buckets;
+    - predicates: the number of gold predicates of the sentence.
+
+    python hw2/evaluate.py data/dev.json --slices slices.json
+    python hw2/slices.py data/dev.json predictions.json --variant 34 --output slices.json
+
+The gold and predicted tags are flattened once into aligned columns, one row per token for the predicate tasks and one
+per (predicate, token) pair for the argument tasks, along with the sentence, predicate and token of each row. The slice
+of every row is then looked up with array indexing, and the counts of all the slices are computed with one bincount per
+slice and count.
+"""
+import logging
+
+logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+import argparse
+import json
+
+from collections import defaultdict
+
+import numpy as np
+from typing import Dict, List, Tuple
+
+import utils
+
+
+# the fields of the sentences needed to slice the scores
+FEATURES = ('pos_tags', 'dependency_relations')
+# upper bounds of the length buckets (the last bucket has no bound)
+LENGTH_BOUNDS = (10, 20, 30, 40, 60)
+# sentences with more gold predicates than this share the last bucket
+MAX_PREDICATES = 5
+
+PREDICATE_SLICES = ('predicate_pos', 'length', 'predicates')
+ARGUMENT_SLICES = ('role', 'predicate_pos', 'argument_relation', 'length', 'predicates')
+
+TASK_NAMES = {
+    'predicate_identification': 'PI',
+    'predicate_disambiguation': 'PD',
+    'argument_identification': 'AI',
+    'argument_classification': 'AC',
+}
+
+
+def flatten(sentences, labels, predictions, with_predicates: bool, null_tag: str = '_') -> Tuple[Dict, Dict]:
+    """
+    Flattens the sentences, gold labels and predictions (indexed by sentence id, in the order of labels) into columns.
+    Tags and features are encoded as integer ids, whose values are the entries of the returned vocabularies.
+
+    Roles are aligned as in utils.evaluate_all: the roles of predicates that appear only in the gold (predicted) labels
+    are aligned with null predicted (gold) roles, and role sequences of different lengths are truncated.
+
+    Returns:
+        A pair (columns, vocabularies). columns contains:
+            - length, predicates: the number of tokens and of gold predicates of each sentence;
+            - offsets, pos, relation: the start of each sentence in, and the POS tag and dependency relation of, all the
+              tokens of the sentences;
+            - predicate_gold, predicate_pred, predicate_sentence, predicate_token: one row per token (with_predicates);
+            - role_gold, role_pred, role_sentence, role_predicate, role_token: one row per (predicate, token) pair.
+        vocabularies maps 'tags', 'pos' and 'relation' to the values of their ids, and 'null' to the id of null_tag.
+    """
+    lengths, predicate_counts, pos, relations = [], [], [], []
+    gold_predicates, pred_predicates, predicate_segments = [], [], []
+    gold_roles, pred_roles, role_segments = [], [], []
+
+    for row, (sentence_id, label) in enumerate(labels.items()):
+        sentence, prediction = sentences[sentence_id], predictions[sentence_id]
+        length = len(sentence['pos_tags'])
+        lengths.append(length)
+        predicate_counts.append(len(label['roles']))
+        pos.extend(sentence['pos_tags'])
+        relations.extend(sentence['dependency_relations'])
+
+        if with_predicates:
+            gold, pred = label['predicates'], prediction['predicates']
+            size = min(len(gold), len(pred))
+            gold_predicates.extend(gold[:size])
+            pred_predicates.extend(pred[:size])
+            predicate_segments.append((row, 0, size))
+
+        gold, pred = label['roles'], prediction['roles']
+        for idx, gold_idx_roles in gold.items():
+            pred_idx_roles = pred.get(idx, [null_tag] * len(gold_idx_roles))
+            size = min(len(gold_idx_roles), len(pred_idx_roles))
+            gold_roles.extend(gold_idx_roles[:size])
+            pred_roles.extend(pred_idx_roles[:size])
+            role_segments.append((row, idx, size))
+        for idx, pred_idx_roles in pred.items():
+            if idx not in gold:
+                size = min(len(pred_idx_roles), length)
+                gold_roles.extend([null_tag] * size)
+                pred_roles.extend(pred_idx_roles[:size])
+                role_segments.append((row, idx, size))
+
+    # ids are assigned in order of appearance, the null tag being 0
+    tags = _vocabulary([null_tag])
+    pos_tags, relation_tags = _vocabulary(), _vocabulary()
+
+    lengths = np.array(lengths, dtype=np.int64)
+    columns = {
+        'length': lengths,
+        'predicates': np.array(predicate_counts, dtype=np.int64),
+        'offsets': np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64),
+        'pos': _encode(pos, pos_tags),
+        'relation': _encode(relations, relation_tags),
+        'predicate_gold': _encode(gold_predicates, tags),
+        'predicate_pred': _encode(pred_predicates, tags),
+        'role_gold': _encode(gold_roles, tags),
+        'role_pred': _encode(pred_roles, tags),
+    }
+    columns['predicate_sentence'], _, columns['predicate_token'] = _expand_segments(predicate_segments)
+    columns['role_sentence'], columns['role_predicate'], columns['role_token'] = _expand_segments(role_segments)
+
+    vocabularies = {'tags': list(tags), 'null': 0, 'pos': list(pos_tags), 'relation': list(relation_tags)}
+    return columns, vocabularies
+
+
+def _vocabulary(values=()) -> defaultdict:
+    # a value -> id mapping that assigns the next free id to unseen values
+    vocabulary = defaultdict(None, {value: i for i, value in enumerate(values)})
+    vocabulary.default_factory = vocabulary.__len__
+    return vocabulary
+
+
+def _encode(values: List[str], vocabulary: defaultdict) -> np.ndarray:
+    return np.fromiter(map(vocabulary.__getitem__, values), dtype=np.int64, count=len(values))
+
+
+def _expand_segments(segments: List[Tuple[int, int, int]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Expands (sentence, predicate, size) segments of consecutive rows into the sentence, predicate and token (i.e. the
+    position in the segment) of every row.
+    """
+    if not segments:
+        return tuple(np.zeros(0, dtype=np.int64) for _ in range(3))
+    sentences, predicates, sizes = (np.array(column, dtype=np.int64) for column in zip(*segments))
+    starts = np.cumsum(sizes) - sizes
+    tokens = np.arange(sizes.sum()) - np.repeat(starts, sizes)
+    return np.repeat(sentences, sizes), np.repeat(predicates, sizes), tokens
+
+
+def count_slices(gold: np.ndarray, pred: np.ndarray, null: int, gold_groups: np.ndarray, pred_groups: np.ndarray, groups: int) -> np.ndarray:
+    """
+    Computes the (true positives, false positives, false negatives) counts of the identification and of the
+    classification of the aligned gold and pred tag ids, for each of groups slices, as a (groups, 2, 3) array.
+    True positives and false negatives are counted in the slice of the gold tag (gold_groups), and false positives in the slice
+    of the predicted one (pred_groups), which is the same for slices of the rows.
+    """
+    gold_positive, pred_positive = gold != null, pred != null
+    correct = gold_positive & (gold == pred)
+
+    def count(slices, flags):
+        return np.bincount(slices[flags], minlength=groups)
+
+    counts = np.empty((groups, 2, 3), dtype=np.int64)
+    counts[:, 0] = np.stack([
+        count(gold_groups, gold_positive & pred_positive),
+        count(pred_groups, pred_positive & ~gold_positive),
+        count(gold_groups, gold_positive & ~pred_positive),
+    ], axis=1)
+    counts[:, 1] = np.stack([
+        count(gold_groups, correct),
+        count(pred_groups, pred_positive & ~correct),
+        count(gold_groups, gold_positive & ~correct),
+    ], axis=1)
+    return counts
+
+
+def _scores(counts: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    The same scores of utils.evaluate_all, for an array of (true positives, false positives, false negatives) counts on
+    its last axis.
+    """
+    true_positives, false_positives, false_negatives = counts[..., 0], counts[..., 1], counts[..., 2]
+
+    def divide(a, b):
+        return np.divide(a, b, out=np.zeros(np.shape(b)), where=b > 0)
+
+    precision = divide(true_positives, true_positives + false_positives)
+    recall = divide(true_positives, true_positives + false_negatives)
+    return {
+        'true_positives': true_positives,
+        'false_positives': false_positives,
+        'false_negatives': false_negatives,
+        'precision': precision,
+        'recall': recall,
+        'f1': divide(2 * precision * recall, precision + recall),
+    }
+
+
+def slice_scores(sentences, labels, predictions, tasks, null_tag='_') -> Dict[str, Dict[str, Dict[str, Dict]]]:
+    """
+    Scores the predictions on every slice of the sentences (which must contain the FEATURES) in labels.
+
+    Returns:
+        A dictionary mapping each slice (e.g. 'argument_relation') to a dictionary mapping each of its values (e.g.
+        'SBJ') to the scores of each task on it, in the same format returned by utils.evaluate_all. Values without
+        counts are left out.
+    """
+    with_predicates = any(task in utils.PREDICATE_TASKS for task in tasks)
+    columns, vocabularies = flatten(sentences, labels, predictions, with_predicates, null_tag)
+
+    length_names = [f'{low + 1}-{high}' for low, high in zip((0,) + LENGTH_BOUNDS, LENGTH_BOUNDS)] + [f'{LENGTH_BOUNDS[-1] + 1}+']
+    predicate_names = [str(count) for count in range(MAX_PREDICATES)] + [f'{MAX_PREDICATES}+']
+
+    def slices_of(level, name):
+        """
+        The (gold, pred) slice of every row of level ('predicate' or 'role') and the values of the slices.
+        """
+        sentence = columns[f'{level}_sentence']
+        if name == 'role':
+            return columns['role_gold'], columns['role_pred'], vocabularies['tags']
+        if name == 'predicate_pos':
+            predicate = columns['predicate_token'] if level == 'predicate' else columns['role_predicate']
+            groups, names = columns['pos'][columns['offsets'][sentence] + predicate], vocabularies['pos']
+        elif name == 'argument_relation':
+            groups, names = columns['relation'][columns['offsets'][sentence] + columns['role_token']], vocabularies['relation']
+        elif name == 'length':
+            groups, names = np.searchsorted(LENGTH_BOUNDS, columns['length'])[sentence], length_names
+        else:
+            groups, names = np.minimum(columns['predicates'], MAX_PREDICATES)[sentence], predicate_names
+        return groups, groups, names
+
+    levels = [('role', ARGUMENT_SLICES, utils.ARGUMENT_TASKS)]
+    if with_predicates:
+        levels.insert(0, ('predicate', PREDICATE_SLICES, utils.PREDICATE_TASKS))
+
+    results = {}
+    for level, slices, level_tasks in levels:
+        gold, pred = columns[f'{level}_gold'], columns[f'{level}_pred']
+        for name in slices:
+            gold_groups, pred_groups, names = slices_of(level, name)
+            counts = count_slices(gold, pred, vocabularies['null'], gold_groups, pred_groups, len(names))
+            scores = _scores(counts)
+            values = results.setdefault(name, {})
+            for g in np.flatnonzero(counts.any(axis=(1, 2))):
+                for t, task in enumerate(level_tasks):
+                    if task in tasks:
+                        values.setdefault(str(names[g]), {})[task] = {
+                            key: value[g, t].item() for key, value in scores.items()
+                        }
+
+    # buckets in their natural order, any other value by decreasing support
+    for name, values in results.items():
+        if name == 'length':
+            results[name] = {value: values[value] for value in length_names if value in values}
+        elif name == 'predicates':
+            results[name] = {value: values[value] for value in predicate_names if value in values}
+        else:
+            results[name] = dict(sorted(values.items(), key=_support_order))
+    return results
+
+
+def _support_order(item):
+    # the support of a value is the number of gold positives of its first task
+    value, value_scores = item
+    scores = next(iter(value_scores.values()))
+    return -(scores['true_positives'] + scores['false_negatives']), value
+
+
+def print_slices(results: Dict[str, Dict[str, Dict[str, Dict]]], tasks):
+    for name, values in results.items():
+        slice_tasks = [task for task in tasks if any(task in value_scores for value_scores in values.values())]
+        header = f'{name.upper().replace("_", " "):<24}' + ''.join(
+            f'{TASK_NAMES[task] + " gold":>10}{TASK_NAMES[task] + " P":>8}{TASK_NAMES[task] + " R":>8}{TASK_NAMES[task] + " F1":>8}'
+            for task in slice_tasks
+        )
+        print(header)
+        print('=' * len(header))
+        for value, value_scores in values.items():
+            line = f'{value[:23]:<24}'
+            for task in slice_tasks:
+                if task in value_scores:
+                    scores = value_scores[task]
+                    gold = scores['true_positives'] + scores['false_negatives']
+                    line += f'{gold:>10}{scores["precision"]:>8.4f}{scores["recall"]:>8.4f}{scores["f1"]:>8.4f}'
+                else:
+                    line += ' ' * 34
+            print(line)
+        print()
+        print()
+
+
+def main(test_path: str, predictions_path: str, variant: str, output: str):
+
+    from significance import load_predictions
+
+    sentences, labels = {}, {}
+    for sentence_id, sentence, label in utils.iter_dataset(test_path):
+        sentences[sentence_id] = {feature: sentence[feature] for feature in FEATURES}
+        labels[sentence_id] = label
+    predictions = load_predictions(predictions_path, variant)
+
+    missing = len(set(labels) - set(predictions))
+    if missing:
+        logging.error(f'The predictions do not cover all the sentences of {test_path} (missing: {missing})')
+        exit(1)
+
+    tasks = utils.VARIANT_TASKS[variant]
+    results = slice_scores(sentences, labels, predictions, tasks)
+
+    print_slices(results, tasks)
+    if output:
+        with open(output, 'w') as f:
+            json.dump({variant: results}, f, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scores of the predictions of a model on slices of the data')
+    parser.add_argument("file", type=str, help='File containing the gold labels')
+    parser.add_argument("predictions", type=str, help='File written by evaluate.py --save-predictions')
+    parser.add_argument("--variant", type=str, default='34', choices=list(utils.VARIANT_TASKS), help='Variant to analyze')
+    parser.add_argument("--output", type=str, default=None, help='File where the scores are written as JSON')
+    args = parser.parse_args()
+
+    main(
+        test_path=args.file,
+        predictions_path=args.predictions,
+        variant=args.variant,
+        output=args.output
+    )
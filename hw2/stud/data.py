@@ -0,0 +1,282 @@
+"""
+Data pipeline for torch models: vocabularies, sentence encoding, length-bucketed batching and collation into padded
+tensors. Sentences are encoded into numpy arrays once (e.g. when a dataset is loaded), so that collating a batch only
+takes a few vectorized copies:
+
+    encoder = SentenceEncoder.build(sentences, labels)
+    dataset = SRLDataset(encoder, sentences, labels)
+    loader = DataLoader(dataset, batch_sampler=BucketBatchSampler(dataset.lengths, 32, shuffle=True), collate_fn=collate)
+
+At inference time, iter_batches yields the batches of a list of sentences sorted by length, together with the indices
+needed to put the predictions back in the original order.
+"""
+import json
+
+import numpy as np
+import torch
+
+from collections import Counter
+from itertools import chain
+from torch.utils.data import Dataset, Sampler
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+
+TOKEN_FIELDS = ('words', 'lemmas', 'pos_tags', 'dependency_relations')
+PAD_TOKEN = '<pad>'
+UNK_TOKEN = '<unk>'
+NULL_TAG = '_'
+# value of the padding positions of label tensors, ignored by torch.nn.CrossEntropyLoss by default
+IGNORE_INDEX = -100
+
+
+class Vocabulary(dict):
+    """
+    A token -> id mapping where unknown tokens are mapped to the id of UNK_TOKEN if the vocabulary has one, and to
+    unk_index otherwise. The padding token, if any, always has id 0.
+    """
+
+    def __init__(self, tokens: Iterable[str] = (), specials: Sequence[str] = (PAD_TOKEN, UNK_TOKEN), unk_index: int = None):
+        super().__init__((token, i) for i, token in enumerate(chain(specials, tokens)))
+        self.itos = list(self)
+        self.unk_index = self.get(UNK_TOKEN, unk_index)
+
+    def __missing__(self, token):
+        if self.unk_index is None:
+            raise KeyError(token)
+        return self.unk_index
+
+    @staticmethod
+    def build(
+            token_lists: Iterable[Sequence[str]], min_frequency: int = 1,
+            specials: Sequence[str] = (PAD_TOKEN, UNK_TOKEN), unk_index: int = None
+    ):
+        """
+        Builds the vocabulary of the tokens occurring at least min_frequency times in token_lists, most frequent first.
+        """
+        counter = Counter(chain.from_iterable(token_lists))
+        tokens = [token for token, count in counter.most_common() if count >= min_frequency and token not in specials]
+        return Vocabulary(tokens, specials, unk_index)
+
+    def encode(self, tokens: Sequence[str]) -> np.ndarray:
+        return np.fromiter(map(self.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+
+    def decode(self, ids: Iterable[int]) -> List[str]:
+        return [self.itos[i] for i in ids]
+
+
+class SentenceEncoder:
+    """
+    Encodes sentences (and, optionally, their labels) into dictionaries of numpy arrays:
+        - one array of ids for each of TOKEN_FIELDS;
+        - dependency_heads, as integers;
+        - predicate_indices, the positions of the predicates (if the sentence has a predicates field, either with
+          senses or with 0/1 flags);
+        - with a label, predicate_senses (the sense of each token, NULL_TAG included) and roles (a matrix with the roles
+          of each predicate, in the order of predicate_indices).
+    """
+
+    def __init__(self, vocabularies: Dict[str, Vocabulary], sense_vocabulary: Vocabulary = None, role_vocabulary: Vocabulary = None):
+        self.vocabularies = vocabularies
+        self.sense_vocabulary = sense_vocabulary
+        self.role_vocabulary = role_vocabulary
+
+    @staticmethod
+    def build(sentences: Iterable[Dict], labels: Iterable[Dict] = None, min_frequency: int = 1):
+        sentences = list(sentences)
+        vocabularies = {
+            field: Vocabulary.build((sentence[field] for sentence in sentences), min_frequency)
+            for field in TOKEN_FIELDS
+        }
+        sense_vocabulary = role_vocabulary = None
+        if labels is not None:
+            labels = list(labels)
+            # label vocabularies have no padding and start with NULL_TAG, while labels never seen in training (e.g. the
+            # senses of new predicates in the dev set) are ignored by the loss
+            sense_vocabulary = Vocabulary.build(
+                (label['predicates'] for label in labels), specials=(NULL_TAG,), unk_index=IGNORE_INDEX)
+            role_vocabulary = Vocabulary.build(
+                chain.from_iterable(label['roles'].values() for label in labels), specials=(NULL_TAG,), unk_index=IGNORE_INDEX)
+        return SentenceEncoder(vocabularies, sense_vocabulary, role_vocabulary)
+
+    def encode(self, sentence: Dict, label: Dict = None) -> Dict[str, np.ndarray]:
+        encoded = {field: vocabulary.encode(sentence[field]) for field, vocabulary in self.vocabularies.items()}
+        encoded['dependency_heads'] = np.array(sentence['dependency_heads'], dtype=np.int64)
+        if 'predicates' in sentence:
+            encoded['predicate_indices'] = predicate_indices(sentence['predicates'])
+
+        if label is not None:
+            encoded['predicate_senses'] = self.sense_vocabulary.encode(label['predicates'])
+            # without predicates in the input (i.e. in 1234), the roles are those of the gold predicates
+            if 'predicate_indices' not in encoded:
+                encoded['predicate_indices'] = predicate_indices(label['predicates'])
+            indices = encoded['predicate_indices']
+            roles = label['roles']
+            encoded['roles'] = np.array(
+                [self.role_vocabulary.encode(roles[i]) for i in indices.tolist()], dtype=np.int64
+            ).reshape(len(indices), len(label['predicates']))
+
+        return encoded
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            json.dump({
+                'vocabularies': {field: vocabulary.itos for field, vocabulary in self.vocabularies.items()},
+                'sense_vocabulary': self.sense_vocabulary.itos if self.sense_vocabulary else None,
+                'role_vocabulary': self.role_vocabulary.itos if self.role_vocabulary else None,
+            }, f)
+
+    @staticmethod
+    def load(path: str):
+        with open(path) as f:
+            state = json.load(f)
+        # the special tokens are saved in front of each vocabulary
+        vocabularies = {field: Vocabulary(itos, specials=()) for field, itos in state['vocabularies'].items()}
+        sense_vocabulary = role_vocabulary = None
+        if state['sense_vocabulary']:
+            sense_vocabulary = Vocabulary(state['sense_vocabulary'], specials=(), unk_index=IGNORE_INDEX)
+        if state['role_vocabulary']:
+            role_vocabulary = Vocabulary(state['role_vocabulary'], specials=(), unk_index=IGNORE_INDEX)
+        return SentenceEncoder(vocabularies, sense_vocabulary, role_vocabulary)
+
+
+def predicate_indices(predicates: Sequence) -> np.ndarray:
+    """
+    The positions of the predicates, given either their senses (NULL_TAG for non predicates) or 0/1 flags.
+    """
+    return np.array([i for i, predicate in enumerate(predicates) if predicate != NULL_TAG and predicate != 0], dtype=np.int64)
+
+
+class SRLDataset(Dataset):
+    """
+    A dataset of sentences (and, optionally, labels), encoded once when the dataset is built.
+    """
+
+    def __init__(self, encoder: SentenceEncoder, sentences: Iterable[Dict], labels: Iterable[Dict] = None):
+        if labels is None:
+            self.samples = [encoder.encode(sentence) for sentence in sentences]
+        else:
+            self.samples = [encoder.encode(sentence, label) for sentence, label in zip(sentences, labels)]
+        self.lengths = np.array([len(sample['words']) for sample in self.samples], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        return self.samples[index]
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Yields batches of indices of sentences with similar lengths, so that little padding is needed. Sentences are
+    sorted by length within pools of bucket_size_multiplier * batch_size sentences (shuffled first, if shuffle), then
+    split in batches of at most batch_size sentences and, if max_tokens is given, at most max_tokens padded tokens.
+    With shuffle, the order of the batches is shuffled too; without it, all the sentences are sorted by length.
+    """
+
+    def __init__(
+            self, lengths: Sequence[int], batch_size: int, max_tokens: int = None, shuffle: bool = False,
+            bucket_size_multiplier: int = 100, drop_last: bool = False, seed: int = None
+    ):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_size_multiplier if shuffle else len(self.lengths)
+        self.drop_last = drop_last
+        self.random = np.random.default_rng(seed)
+
+    def _batches(self, random) -> List[np.ndarray]:
+        order = random.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), max(self.bucket_size, 1)):
+            bucket = order[start:start + self.bucket_size]
+            # a stable sort keeps the sentences of equal length in their original order
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(self._split(bucket))
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in random.permutation(len(batches))]
+        return batches
+
+    def _split(self, bucket: np.ndarray) -> Iterator[np.ndarray]:
+        if self.max_tokens is None:
+            for start in range(0, len(bucket), self.batch_size):
+                yield bucket[start:start + self.batch_size]
+            return
+
+        # the bucket is sorted, so the padded size of a batch is its size times the length of its last sentence
+        start = 0
+        while start < len(bucket):
+            end = start + 1
+            while end < len(bucket) and end - start < self.batch_size and (end - start + 1) * self.lengths[bucket[end]] <= self.max_tokens:
+                end += 1
+            yield bucket[start:end]
+            start = end
+
+    def __iter__(self):
+        return (batch.tolist() for batch in self._batches(self.random))
+
+    def __len__(self):
+        # with max_tokens and shuffle, the number of batches can change slightly from one epoch to the other
+        return len(self._batches(np.random.default_rng(0)))
+
+
+def collate(samples: List[Dict[str, np.ndarray]]) -> Dict[str, torch.Tensor]:
+    """
+    Collates encoded sentences into a batch of padded tensors:
+        - one (batch, length) tensor of ids for each of TOKEN_FIELDS and for dependency_heads, padded with 0;
+        - mask, a (batch, length) boolean tensor that is False on padding, and lengths, a (batch,) tensor;
+        - if the sentences have predicate_indices, the predicates of the whole batch flattened into
+          predicate_sentence_indices and predicate_token_indices, two (predicates,) tensors with the position of each
+          predicate in the batch, and predicates, a (batch, length) tensor of 0/1 flags;
+        - if the sentences have labels, predicate_senses as a (batch, length) tensor and roles as a
+          (predicates, length) tensor, padded with IGNORE_INDEX.
+    """
+    lengths = np.fromiter((len(sample['words']) for sample in samples), dtype=np.int64, count=len(samples))
+    mask = np.arange(lengths.max()) < lengths[:, None]
+
+    def pad(arrays, value=0):
+        padded = np.full(mask.shape, value, dtype=np.int64)
+        padded[mask] = np.concatenate(arrays)
+        return torch.from_numpy(padded)
+
+    batch = {field: pad([sample[field] for sample in samples]) for field in TOKEN_FIELDS + ('dependency_heads',)}
+    batch['mask'] = torch.from_numpy(mask)
+    batch['lengths'] = torch.from_numpy(lengths)
+
+    if 'predicate_indices' in samples[0]:
+        sentence_indices, token_indices = _flatten_predicates([sample['predicate_indices'] for sample in samples])
+        predicates = np.zeros(mask.shape, dtype=np.int64)
+        predicates[sentence_indices, token_indices] = 1
+        batch['predicate_sentence_indices'] = torch.from_numpy(sentence_indices)
+        batch['predicate_token_indices'] = torch.from_numpy(token_indices)
+        batch['predicates'] = torch.from_numpy(predicates)
+
+    if 'roles' in samples[0]:
+        batch['predicate_senses'] = pad([sample['predicate_senses'] for sample in samples], IGNORE_INDEX)
+        roles = np.full((len(sentence_indices), mask.shape[1]), IGNORE_INDEX, dtype=np.int64)
+        roles[mask[sentence_indices]] = np.concatenate([sample['roles'].ravel() for sample in samples])
+        batch['roles'] = torch.from_numpy(roles)
+
+    return batch
+
+
+def _flatten_predicates(indices: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    counts = np.fromiter(map(len, indices), dtype=np.int64, count=len(indices))
+    sentence_indices = np.repeat(np.arange(len(indices), dtype=np.int64), counts)
+    token_indices = np.concatenate(indices).astype(np.int64)
+    return sentence_indices, token_indices
+
+
+def iter_batches(
+        encoder: SentenceEncoder, sentences: Sequence[Dict], batch_size: int = 32, max_tokens: Optional[int] = None
+) -> Iterator[Tuple[List[int], Dict[str, torch.Tensor]]]:
+    """
+    Yields (indices, batch) pairs covering sentences in order of length, where indices are the positions in
+    sentences of the sentences in batch.
+    """
+    samples = [encoder.encode(sentence) for sentence in sentences]
+    lengths = [len(sample['words']) for sample in samples]
+    for indices in BucketBatchSampler(lengths, batch_size, max_tokens=max_tokens):
+        yield indices, collate([samples[i] for i in indices])
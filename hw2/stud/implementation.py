@@ -1,10 +1,12 @@
 import json
-import random
+import threading
 
 import numpy as np
+from itertools import chain, compress, repeat
 from typing import List, Tuple
 
 from model import Model
+from pipeline import lookup_batch
 
 
 def build_model_34(device: str) -> Model:
@@ -51,55 +53,182 @@ def build_model_1234(device: str) -> Model:
     raise NotImplementedError
 
 
+class _Vocabulary(dict):
+    """
+    A token -> id mapping where unknown tokens are mapped to len(vocabulary).
+    """
+
+    def __missing__(self, token):
+        return len(self)
+
+
+# the (probability, label) of the dependency relations that are not in the baselines
+_NO_ARGUMENT = (0.0, '_')
+
+
+class _BaselineTables:
+    """
+    The baselines compiled into vocabularies and numpy arrays. Unknown POS tags, dependency relations and lemmas are
+    mapped to one extra (last) entry that is never a predicate, never an argument and has no sense.
+    """
+
+    def __init__(self, baselines):
+        self.baselines = baselines
+
+        predicate_identification = baselines['predicate_identification']
+        self.pos_vocab = _Vocabulary((pos, i) for i, pos in enumerate(predicate_identification))
+        self.predicate_probs = np.array(
+            [_BaselineTables._probability(counts) for counts in predicate_identification.values()] + [0.0])
+
+        argument_identification = baselines['argument_identification']
+        argument_classification = baselines['argument_classification']
+        self.relation_vocab = _Vocabulary((relation, i) for i, relation in enumerate(argument_identification))
+        self.argument_probs = np.array(
+            [_BaselineTables._probability(counts) for counts in argument_identification.values()] + [0.0])
+        self.argument_labels = np.array(
+            [argument_classification.get(relation, '_') for relation in argument_identification] + ['_'], dtype=object)
+
+        predicate_disambiguation = baselines['predicate_disambiguation']
+        self.lemma_vocab = _Vocabulary((lemma, i) for i, lemma in enumerate(predicate_disambiguation))
+        self.lemma_senses = np.array(list(predicate_disambiguation.values()) + ['_'], dtype=object)
+
+        # the same tables as plain dictionaries, faster than arrays for a few sentences
+        self.pos_predicate_probs = dict(zip(predicate_identification, self.predicate_probs.tolist()))
+        self.relation_arguments = dict(zip(argument_identification, zip(self.argument_probs.tolist(), self.argument_labels)))
+        self.lemma_sense = predicate_disambiguation
+
+    @staticmethod
+    def _probability(counts):
+        return counts['positive'] / counts['total'] if counts['total'] else 0.0
+
+
 class Baseline(Model):
     """
     A very simple baseline to test that the evaluation script works.
+    The baselines are compiled once per process into vocabularies and numpy arrays, so that predicting a batch of
+    sentences only takes a few array lookups and a single random draw. Batches smaller than SMALL_BATCH, whose cost
+    would be dominated by the overhead of numpy, are predicted sentence by sentence with plain dictionaries instead.
+    Every path takes two random numbers per token (for its predicate and its argument), in the order of the sentences,
+    from the same generator: a seeded Baseline predicts the same sequence of sentences in the same way, however they
+    are batched.
     """
 
-    def __init__(self, return_predicates=False):
-        self.baselines = Baseline._load_baselines()
+    SMALL_BATCH = 16
+
+    _tables = {}
+    _tables_lock = threading.Lock()
+
+    def __init__(self, return_predicates=False, seed=None):
+        self.tables = Baseline._load_tables()
+        self.baselines = self.tables.baselines
         self.return_predicates = return_predicates
+        self.random = np.random.default_rng(seed)
+
+    @staticmethod
+    def _lookup(vocab, sentences, field):
+        tokens = chain.from_iterable(sentence[field] for sentence in sentences)
+        return np.fromiter(map(vocab.__getitem__, tokens), dtype=np.int64)
 
     def predict(self, sentence):
-        predicate_identification = []
-        for pos in sentence['pos_tags']:
-            prob = self.baselines['predicate_identification'][pos]['positive'] / self.baselines['predicate_identification'][pos]['total']
-            if random.random() < prob:
-                predicate_identification.append(True)
-            else:
-                predicate_identification.append(False)
-        
-        predicate_disambiguation = []
+        tables = self.tables
+        draws = self.random.random(2 * len(sentence['pos_tags'])).tolist()
+
+        senses = [
+            tables.lemma_sense.get(lemma, '_') if draw < tables.pos_predicate_probs.get(pos, 0.0) else '_'
+            for pos, lemma, draw in zip(sentence['pos_tags'], sentence['lemmas'], draws[0::2])
+        ]
+        argument_tokens = map(tables.relation_arguments.get, sentence['dependency_relations'], repeat(_NO_ARGUMENT))
+        roles = [label if draw < probability else '_' for (probability, label), draw in zip(argument_tokens, draws[1::2])]
+        return self._prediction(senses, roles, [i for i, sense in enumerate(senses) if sense != '_'])
+
+    def _token_probabilities(self, sentence):
+        """
+        Returns the tokens of sentence that may be predicates, as (index, probability, sense), and, for each token, its
+        probability of being an argument with its label.
+        """
+        tables = self.tables
+        predicate_probs = list(map(tables.pos_predicate_probs.get, sentence['pos_tags'], repeat(0.0)))
+        lemmas = sentence['lemmas']
+        predicate_candidates = [
+            (i, predicate_probs[i], tables.lemma_sense.get(lemmas[i], '_'))
+            for i in compress(range(len(predicate_probs)), predicate_probs)
+        ]
+        argument_tokens = list(map(tables.relation_arguments.get, sentence['dependency_relations'], repeat(_NO_ARGUMENT)))
+        return predicate_candidates, argument_tokens
+
+    def _predict_sentence(self, predicate_candidates, argument_tokens):
+        draws = self.random.random(2 * len(argument_tokens)).tolist()
+        senses = ['_'] * len(argument_tokens)
         predicate_indices = []
-        for idx, (lemma, is_predicate) in enumerate(zip(sentence['lemmas'], predicate_identification)):
-            if not is_predicate or lemma not in self.baselines['predicate_disambiguation']:
-                predicate_disambiguation.append('_')
-            else:
-                predicate_disambiguation.append(self.baselines['predicate_disambiguation'][lemma])
-                predicate_indices.append(idx)
-        
-        argument_identification = []
-        for dependency_relation in sentence['dependency_relations']:
-            prob = self.baselines['argument_identification'][dependency_relation]['positive'] / self.baselines['argument_identification'][dependency_relation]['total']
-            if random.random() < prob:
-                argument_identification.append(True)
-            else:
-                argument_identification.append(False)
+        for i, probability, sense in predicate_candidates:
+            if draws[2 * i] < probability and sense != '_':
+                senses[i] = sense
+                predicate_indices.append(i)
+        roles = [label if draw < probability else '_' for (probability, label), draw in zip(argument_tokens, draws[1::2])]
+        return self._prediction(senses, roles, predicate_indices)
 
-        argument_classification = []
-        for dependency_relation, is_argument in zip(sentence['dependency_relations'], argument_identification):
-            if not is_argument:
-                argument_classification.append('_')
-            else:
-                argument_classification.append(self.baselines['argument_classification'][dependency_relation])
-        
+    def _prediction(self, senses, roles, predicate_indices):
         if self.return_predicates:
-            return {
-                'predicates': predicate_disambiguation,
-                'roles': {i: argument_classification for i in predicate_indices},
-            }
-        else:
-            return {'roles': {i: argument_classification for i in predicate_indices}}
+            return {'predicates': senses, 'roles': {i: roles for i in predicate_indices}}
+        return {'roles': {i: roles for i in predicate_indices}}
+
+    def predict_batch(self, sentences):
+        if len(sentences) < Baseline.SMALL_BATCH:
+            return [self.predict(sentence) for sentence in sentences]
+        pos_ids = Baseline._lookup(self.tables.pos_vocab, sentences, 'pos_tags')
+        relation_ids = Baseline._lookup(self.tables.relation_vocab, sentences, 'dependency_relations')
+        lemma_ids = Baseline._lookup(self.tables.lemma_vocab, sentences, 'lemmas')
+        return self._predict(sentences, pos_ids, relation_ids, lemma_ids)
+
+    def predict_batch_with_contexts(self, sentences, contexts):
+        # the lookups are shared with the other Baseline instances, since they all use the same tables
+        if len(sentences) < Baseline.SMALL_BATCH:
+            key = ('baseline_tokens', id(self.tables))
+            predictions = []
+            for sentence, context in zip(sentences, contexts):
+                tokens = context.get(key, self._token_probabilities, sentence)
+                predictions.append(self._predict_sentence(*tokens))
+            return predictions
+        pos_ids = lookup_batch(contexts, 'pos_tags', self.tables.pos_vocab)
+        relation_ids = lookup_batch(contexts, 'dependency_relations', self.tables.relation_vocab)
+        lemma_ids = lookup_batch(contexts, 'lemmas', self.tables.lemma_vocab)
+        return self._predict(sentences, pos_ids, relation_ids, lemma_ids)
+
+    def _predict(self, sentences, pos_ids, relation_ids, lemma_ids):
+        tables = self.tables
+        draws = self.random.random((len(pos_ids), 2))
+
+        is_predicate = (draws[:, 0] < tables.predicate_probs[pos_ids]) & (lemma_ids < len(tables.lemma_vocab))
+        predicate_disambiguation = tables.lemma_senses[lemma_ids]
+        predicate_disambiguation[~is_predicate] = '_'
+
+        is_argument = draws[:, 1] < tables.argument_probs[relation_ids]
+        argument_classification = tables.argument_labels[relation_ids]
+        argument_classification[~is_argument] = '_'
+
+        predictions = []
+        start = 0
+        for sentence in sentences:
+            end = start + len(sentence['pos_tags'])
+            predicate_indices = is_predicate[start:end].nonzero()[0].tolist()
+            roles = argument_classification[start:end].tolist()
+            if self.return_predicates:
+                predictions.append({
+                    'predicates': predicate_disambiguation[start:end].tolist(),
+                    'roles': {i: roles for i in predicate_indices},
+                })
+            else:
+                predictions.append({'roles': {i: roles for i in predicate_indices}})
+            start = end
+
+        return predictions
+
+    @staticmethod
+    def _load_tables(path='data/baselines.json'):
+        with Baseline._tables_lock:
+            if path not in Baseline._tables:
+                Baseline._tables[path] = _BaselineTables(Baseline._load_baselines(path))
+            return Baseline._tables[path]
 
     @staticmethod
     def _load_baselines(path='data/baselines.json'):
@@ -112,6 +241,9 @@ class StudentModel(Model):
     
     # STUDENT: construct here your model
     # this class should be loading your weights and vocabulary
+    # set deterministic = True if your predictions only depend on the input sentence, to let the server cache them
+    # stud/data.py provides vocabularies, length-bucketed batching and collation of sentences into padded tensors
+    # stud/srl_model.py provides EncodeOnceModel, which encodes each sentence once and scores all its predicates together
 
     def predict(self, sentence):
         """
@@ -172,3 +304,15 @@ class StudentModel(Model):
                     }
         """
         pass
+
+    def predict_batch(self, sentences):
+        """
+        --> !!! STUDENT: OPTIONALLY, implement here a batched version of your predict function !!! <--
+
+        Args:
+            sentences: a list of dictionaries, each one in the same format accepted by predict.
+
+        Returns:
+            A list with one prediction (in the same format returned by predict) for each input sentence, in the same order.
+        """
+        return super().predict_batch(sentences)
@@ -0,0 +1,157 @@
+"""
+Encode-once SRL models: each sentence is encoded a single time, then the arguments of all its predicates (given in
+input or identified on the fly) are scored with one batched operation, instead of re-encoding the sentence for each
+predicate. To use it, subclass SRLModule with your network and wrap it in an EncodeOnceModel:
+
+    class MyModule(SRLModule):
+        def __init__(self, ...):
+            super().__init__()
+            self.lstm = ...
+            self.arguments = ArgumentScorer(hidden_size, hidden_size, len(encoder.role_vocabulary))
+
+        def encode(self, batch):
+            return self.lstm(...)  # (batch, length, hidden_size)
+
+        def score_arguments(self, states, batch, sentence_indices, token_indices):
+            return self.arguments(states, sentence_indices, token_indices)
+
+    def build_model_34(device):
+        encoder = SentenceEncoder.load('model/encoder.json')
+        module = MyModule(...)
+        module.load_state_dict(torch.load('model/weights.pt', map_location=device))
+        return EncodeOnceModel(encoder, module, device)
+"""
+import numpy as np
+import torch
+
+from typing import Dict, List
+
+from model import Model
+from stud.data import NULL_TAG, SentenceEncoder, iter_batches
+
+
+class SRLModule(torch.nn.Module):
+    """
+    The network of an EncodeOnceModel. Subclasses implement encode and score_arguments and, if the model predicts
+    predicates, identify_predicates (for 1234) and disambiguate_predicates (for 234 and 1234).
+    """
+
+    def encode(self, batch: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """
+        Encodes a batch (see stud.data.collate) into (batch, length, hidden) token states.
+        """
+        raise NotImplementedError
+
+    def score_arguments(
+            self, states: torch.Tensor, batch: Dict[str, torch.Tensor],
+            sentence_indices: torch.Tensor, token_indices: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Scores the arguments of all the predicates of the batch at once, where the predicate p is the token
+        token_indices[p] of the sentence sentence_indices[p]. Returns (predicates, length, roles) logits.
+        """
+        raise NotImplementedError
+
+    def identify_predicates(self, states: torch.Tensor, batch: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """
+        Returns (batch, length) logits of each token being a predicate.
+        """
+        raise NotImplementedError
+
+    def disambiguate_predicates(
+            self, states: torch.Tensor, batch: Dict[str, torch.Tensor],
+            sentence_indices: torch.Tensor, token_indices: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Returns (predicates, senses) logits for the given predicates (see score_arguments).
+        """
+        raise NotImplementedError
+
+
+class ArgumentScorer(torch.nn.Module):
+    """
+    Scores every token as an argument of every predicate with an MLP over the pair of their states. Both states are
+    projected once (per token and per predicate) and the projections are summed, which is equivalent to applying the
+    first layer of the MLP to their concatenation, but does not copy the token states once per predicate.
+    """
+
+    def __init__(self, input_size: int, hidden_size: int, num_roles: int, dropout: float = 0.0):
+        super().__init__()
+        self.argument_projection = torch.nn.Linear(input_size, hidden_size)
+        self.predicate_projection = torch.nn.Linear(input_size, hidden_size, bias=False)
+        self.dropout = torch.nn.Dropout(dropout)
+        self.output = torch.nn.Linear(hidden_size, num_roles)
+
+    def forward(self, states: torch.Tensor, sentence_indices: torch.Tensor, token_indices: torch.Tensor) -> torch.Tensor:
+        arguments = self.argument_projection(states)
+        predicates = self.predicate_projection(states[sentence_indices, token_indices])
+        hidden = arguments.index_select(0, sentence_indices) + predicates.unsqueeze(1)
+        return self.output(self.dropout(torch.relu(hidden)))
+
+
+class EncodeOnceModel(Model):
+    """
+    Runs an SRLModule on batches of sentences sorted by length. Predicates are taken from the predicates field of the
+    sentences or, if they have none (i.e. in 1234), identified by the module; their senses are predicted if
+    return_predicates. The outputs are decoded with the vocabularies of encoder into the format of Model.predict.
+    """
+
+    deterministic = True
+
+    def __init__(
+            self, encoder: SentenceEncoder, module: SRLModule, device: str = 'cpu',
+            return_predicates: bool = False, batch_size: int = 32, max_tokens: int = None
+    ):
+        self.encoder = encoder
+        self.module = module.to(device).eval()
+        self.device = device
+        self.return_predicates = return_predicates
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.roles = np.array(encoder.role_vocabulary.itos, dtype=object)
+        self.senses = np.array(encoder.sense_vocabulary.itos, dtype=object) if encoder.sense_vocabulary else None
+
+    def predict(self, sentence):
+        return self.predict_batch([sentence])[0]
+
+    def predict_batch(self, sentences):
+        predictions = [None] * len(sentences)
+        with torch.no_grad():
+            for indices, batch in iter_batches(self.encoder, sentences, self.batch_size, self.max_tokens):
+                batch = {name: tensor.to(self.device) for name, tensor in batch.items()}
+                for i, prediction in zip(indices, self._predict(batch)):
+                    predictions[i] = prediction
+        return predictions
+
+    def _predict(self, batch: Dict[str, torch.Tensor]) -> List[Dict]:
+        states = self.module.encode(batch)
+
+        if 'predicate_sentence_indices' in batch:
+            sentence_indices, token_indices = batch['predicate_sentence_indices'], batch['predicate_token_indices']
+        else:
+            is_predicate = (self.module.identify_predicates(states, batch) > 0) & batch['mask']
+            sentence_indices, token_indices = is_predicate.nonzero(as_tuple=True)
+
+        lengths = batch['lengths'].tolist()
+        sentence_indices_list = sentence_indices.tolist()
+        token_indices_list = token_indices.tolist()
+
+        roles = [{} for _ in lengths]
+        if sentence_indices_list:
+            role_ids = self.module.score_arguments(states, batch, sentence_indices, token_indices).argmax(-1)
+            for s, t, labels in zip(sentence_indices_list, token_indices_list, self.roles[role_ids.cpu().numpy()].tolist()):
+                roles[s][t] = labels[:lengths[s]]
+
+        if not self.return_predicates:
+            return [{'roles': sentence_roles} for sentence_roles in roles]
+
+        predicates = [[NULL_TAG] * length for length in lengths]
+        if sentence_indices_list:
+            sense_ids = self.module.disambiguate_predicates(states, batch, sentence_indices, token_indices).argmax(-1)
+            for s, t, sense in zip(sentence_indices_list, token_indices_list, self.senses[sense_ids.cpu().numpy()].tolist()):
+                predicates[s][t] = sense
+
+        return [
+            {'predicates': sentence_predicates, 'roles': sentence_roles}
+            for sentence_predicates, sentence_roles in zip(predicates, roles)
+        ]
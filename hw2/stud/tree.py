@@ -0,0 +1,171 @@
+"""
+Dependency tree features computed once per sentence as numpy arrays: parents, depths, children, and the lowest common
+ancestor (LCA), distance and path between tokens, answered in bulk for all the tokens and predicates of a sentence.
+
+    tree = dependency_tree(sentence['dependency_heads'])
+    distances = tree.distances(predicate_indices)  # (predicates, tokens)
+
+LCAs are computed with an Euler tour of the tree and a sparse table of the minimum depth over its ranges, so that each
+query takes constant time after an O(n log n) construction. Trees are cached by heads, hence models running in the same
+process (e.g. the three variants on the same sentence) share them.
+"""
+import numpy as np
+
+from functools import lru_cache
+from typing import List, Sequence, Tuple
+
+
+UP, DOWN = '↑', '↓'
+
+
+class DependencyTree:
+    """
+    The dependency tree of a sentence, given the (1-based) head of each token, 0 being the root. Token indices in
+    inputs and outputs are 0-based; internally, node 0 is a virtual root and node i + 1 is token i.
+
+    Attributes:
+        parents: the (0-based) head of each token, -1 for the tokens attached to the root.
+        depths: the distance of each token from the root of the sentence (0 for the tokens attached to the root).
+        child_offsets, children: the (0-based) children of each token in CSR form, i.e. the children of token i are
+            children[child_offsets[i]:child_offsets[i + 1]].
+    """
+
+    def __init__(self, heads: Sequence[int]):
+        heads = np.asarray(heads, dtype=np.int64)
+        n = len(heads)
+        self.size = n
+        self._parents = np.concatenate([[-1], heads])
+
+        # children of every node (the virtual root included), sorted by node
+        order = np.argsort(heads, kind='stable')
+        node_offsets = np.zeros(n + 2, dtype=np.int64)
+        np.cumsum(np.bincount(heads, minlength=n + 1), out=node_offsets[1:])
+        node_children = order + 1
+
+        # iterative depth-first visit from the virtual root, recording the Euler tour of the nodes
+        depths = np.zeros(n + 1, dtype=np.int64)
+        first = np.full(n + 1, -1, dtype=np.int64)
+        tour, tour_depths = [], []
+        stack = [(0, node_offsets[0])]
+        while stack:
+            node, next_child = stack[-1]
+            if first[node] < 0:
+                first[node] = len(tour)
+            tour.append(node)
+            tour_depths.append(depths[node])
+            if next_child < node_offsets[node + 1]:
+                child = node_children[next_child]
+                stack[-1] = node, next_child + 1
+                depths[child] = depths[node] + 1
+                stack.append((child, node_offsets[child]))
+            else:
+                stack.pop()
+        if (first < 0).any():
+            raise ValueError(f'The dependency heads do not form a tree: {heads.tolist()}')
+
+        self._depths = depths
+        self._first = first
+        self._tour = np.array(tour, dtype=np.int64)
+        self._table = _sparse_table(np.array(tour_depths, dtype=np.int64))
+
+        self.parents = heads - 1
+        self.depths = depths[1:] - 1
+        self.child_offsets = node_offsets[1:] - node_offsets[1]
+        self.children = node_children[node_offsets[1]:] - 1
+        self.root_children = node_children[:node_offsets[1]] - 1
+
+    def children_of(self, token: int) -> np.ndarray:
+        return self.children[self.child_offsets[token]:self.child_offsets[token + 1]]
+
+    def lcas(self, predicates: Sequence[int]) -> np.ndarray:
+        """
+        A (predicates, tokens) matrix with the LCA of each predicate and each token, -1 if it is the virtual root
+        (i.e. if they are in the subtrees of different roots).
+        """
+        return self._lca_nodes(*self._pairs(predicates)) - 1
+
+    def distances(self, predicates: Sequence[int]) -> np.ndarray:
+        """
+        A (predicates, tokens) matrix with the number of arcs between each predicate and each token.
+        """
+        predicate_nodes, token_nodes = self._pairs(predicates)
+        lcas = self._lca_nodes(predicate_nodes, token_nodes)
+        return self._depths[predicate_nodes] + self._depths[token_nodes] - 2 * self._depths[lcas]
+
+    def path_lengths(self, predicates: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Two (predicates, tokens) matrices with, for each token, the number of arcs from the token up to its LCA with
+        each predicate and the number of arcs from that LCA down to the predicate.
+        """
+        predicate_nodes, token_nodes = self._pairs(predicates)
+        lca_depths = self._depths[self._lca_nodes(predicate_nodes, token_nodes)]
+        return self._depths[token_nodes] - lca_depths, self._depths[predicate_nodes] - lca_depths
+
+    def path(self, token: int, predicate: int) -> Tuple[List[int], List[int]]:
+        """
+        The tokens on the path from token up to the LCA (excluded) and from the LCA (excluded) down to predicate.
+        """
+        up_length, down_length = (lengths[0, token] for lengths in self.path_lengths([predicate]))
+        up, down = [], []
+        node = token + 1
+        for _ in range(up_length):
+            up.append(node - 1)
+            node = self._parents[node]
+        node = predicate + 1
+        for _ in range(down_length):
+            down.append(node - 1)
+            node = self._parents[node]
+        return up, down[::-1]
+
+    def relation_paths(self, predicate: int, relations: Sequence[str]) -> List[str]:
+        """
+        The syntactic path from each token to predicate, as the relations of the arcs climbed (followed by UP) and
+        descended (followed by DOWN), e.g. 'SBJ↑OBJ↓' from the subject of a verb to its object.
+        """
+        paths = []
+        for token in range(self.size):
+            up, down = self.path(token, predicate)
+            paths.append(''.join([relations[i] + UP for i in up] + [relations[i] + DOWN for i in down]))
+        return paths
+
+    def _pairs(self, predicates: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+        predicate_nodes = np.asarray(predicates, dtype=np.int64)[:, None] + 1
+        token_nodes = np.arange(1, self.size + 1)[None, :]
+        return np.broadcast_arrays(predicate_nodes, token_nodes)
+
+    def _lca_nodes(self, u: np.ndarray, v: np.ndarray) -> np.ndarray:
+        left = np.minimum(self._first[u], self._first[v])
+        right = np.maximum(self._first[u], self._first[v]) + 1
+        # the two (overlapping) power-of-two ranges covering [left, right)
+        level = np.floor(np.log2(right - left)).astype(np.int64)
+        a = self._table[level, left]
+        b = self._table[level, right - (1 << level)]
+        depths = self._depths[self._tour]
+        return self._tour[np.where(depths[a] <= depths[b], a, b)]
+
+
+def _sparse_table(values: np.ndarray) -> np.ndarray:
+    """
+    table[k, i] is the position of the minimum of values[i:i + 2 ** k] (positions past the end are not meaningful).
+    """
+    levels = max(1, int(np.log2(len(values))) + 1)
+    table = np.zeros((levels, len(values)), dtype=np.int64)
+    table[0] = np.arange(len(values))
+    for k in range(1, levels):
+        previous = table[k - 1]
+        shifted = np.concatenate([previous[1 << (k - 1):], previous[-(1 << (k - 1)):]])
+        table[k] = np.where(values[previous] <= values[shifted], previous, shifted)
+    return table
+
+
+@lru_cache(maxsize=4096)
+def _cached_tree(heads: Tuple[int, ...]) -> DependencyTree:
+    return DependencyTree(heads)
+
+
+def dependency_tree(heads: Sequence) -> DependencyTree:
+    """
+    The (cached) DependencyTree of the given heads, which can be integers or strings (as sent to the server).
+    The returned tree is shared: do not modify its arrays.
+    """
+    return _cached_tree(tuple(int(head) for head in heads))
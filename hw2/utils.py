@@ -1,4 +1,8 @@
 import json
+import os
+import re
+
+import numpy as np
 
 
 def read_dataset(path: str):
@@ -8,24 +12,133 @@ def read_dataset(path: str):
     
     sentences, labels = {}, {}
     for sentence_id, sentence in dataset.items():
-        sentence_id = int(sentence_id)
-        sentences[sentence_id] = {
-            'words': sentence['words'],
-            'lemmas': sentence['lemmas'],
-            'pos_tags': sentence['pos_tags'],
-            'dependency_heads': [int(head) for head in sentence['dependency_heads']],
-            'dependency_relations': sentence['dependency_relations'],
-            'predicates': sentence['predicates'],
-        }
-
-        labels[sentence_id] = {
-            'predicates': sentence['predicates'],
-            'roles': {int(p): r for p, r in sentence['roles'].items()}
-        }
+        sentence_id, sentences[sentence_id], labels[sentence_id] = _parse_sentence(sentence_id, sentence)
 
     return sentences, labels
 
 
+def iter_dataset(path: str):
+    """
+    Lazily yields (sentence_id, sentence, label) triples, in the same format returned by read_dataset, without loading
+    the whole file in memory. Files ending in .jsonl are read as JSON lines, where each line is an object mapping
+    sentence ids to sentences (i.e. one or more entries of the regular format). Any other file is expected to be in the
+    regular format, and is decoded incrementally one sentence at a time. Directories are read as datasets encoded by
+    encoded_dataset.build_encoded_dataset.
+    """
+    if os.path.isdir(path):
+        from encoded_dataset import EncodedDataset
+        for sentence_id, sentence, label in EncodedDataset(path):
+            yield sentence_id, dict(sentence), label
+        return
+
+    for sentence_id, sentence in _iter_entries(path):
+        yield _parse_sentence(sentence_id, sentence)
+
+
+def dataset_size(path: str) -> int:
+    """
+    Returns the number of sentences of the dataset in path, read from the header of datasets encoded by
+    encoded_dataset.build_encoded_dataset, and otherwise counted by streaming the file once without parsing the
+    sentences (a fraction of the time needed to evaluate them).
+    """
+    if os.path.isdir(path):
+        from encoded_dataset import encoded_dataset_size
+        return encoded_dataset_size(path)
+    return sum(1 for _ in _iter_entries(path))
+
+
+def _iter_entries(path: str):
+    return _iter_json_lines(path) if path.endswith('.jsonl') else _iter_json_object(path)
+
+
+def _parse_sentence(sentence_id, sentence):
+    sentence_id = int(sentence_id)
+    parsed_sentence = {
+        'words': sentence['words'],
+        'lemmas': sentence['lemmas'],
+        'pos_tags': sentence['pos_tags'],
+        'dependency_heads': [int(head) for head in sentence['dependency_heads']],
+        'dependency_relations': sentence['dependency_relations'],
+        'predicates': sentence['predicates'],
+    }
+
+    label = {
+        'predicates': sentence['predicates'],
+        'roles': {int(p): r for p, r in sentence['roles'].items()}
+    }
+
+    return sentence_id, parsed_sentence, label
+
+
+def _iter_json_lines(path: str):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield from json.loads(line).items()
+
+
+_WHITESPACE = re.compile(r'\s*')
+
+
+def _iter_json_object(path: str, chunk_size: int = 1 << 20):
+    """
+    Yields the (key, value) pairs of the top-level JSON object stored in path, reading chunk_size characters at a time.
+    """
+    decoder = json.JSONDecoder()
+
+    with open(path) as f:
+
+        buffer, position, eof = '', 0, False
+
+        def fill():
+            nonlocal buffer, position, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+
+        def peek():
+            nonlocal position
+            while True:
+                position = _WHITESPACE.match(buffer, position).end()
+                if position < len(buffer):
+                    return buffer[position]
+                if eof:
+                    raise ValueError(f'Unexpected end of file while reading {path}')
+                fill()
+
+        def expect(chars):
+            nonlocal position
+            char = peek()
+            if char not in chars:
+                raise ValueError(f'Expected one of {chars!r} but found {char!r} while reading {path}')
+            position += 1
+            return char
+
+        def read_value():
+            nonlocal position
+            peek()
+            while True:
+                try:
+                    value, position = decoder.raw_decode(buffer, position)
+                    return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    fill()
+
+        expect('{')
+        if peek() == '}':
+            return
+
+        while True:
+            key = read_value()
+            expect(':')
+            yield key, read_value()
+            if expect(',}') == '}':
+                return
+
+
 def evaluate_predicate_identification(labels, predictions, null_tag='_'):
     true_positives, false_positives, false_negatives = 0, 0, 0
     for sentence_id in labels:
@@ -38,17 +151,7 @@ def evaluate_predicate_identification(labels, predictions, null_tag='_'):
                 false_positives += 1
             elif g != null_tag and p == null_tag:
                 false_negatives += 1
-    precision = true_positives / (true_positives + false_positives)
-    recall = true_positives / (true_positives + false_negatives)
-    f1 = 2 * (precision * recall) / (precision + recall)
-    return {
-        'true_positives': true_positives,
-        'false_positives': false_positives,
-        'false_negatives': false_negatives,
-        'precision': precision,
-        'recall': recall,
-        'f1': f1
-    }
+    return _get_scores(true_positives, false_positives, false_negatives)
 
 
 def evaluate_predicate_disambiguation(labels, predictions, null_tag='_'):
@@ -67,17 +170,7 @@ def evaluate_predicate_disambiguation(labels, predictions, null_tag='_'):
                 false_positives += 1
             elif g != null_tag and p == null_tag:
                 false_negatives += 1
-    precision = true_positives / (true_positives + false_positives)
-    recall = true_positives / (true_positives + false_negatives)
-    f1 = 2 * (precision * recall) / (precision + recall)
-    return {
-        'true_positives': true_positives,
-        'false_positives': false_positives,
-        'false_negatives': false_negatives,
-        'precision': precision,
-        'recall': recall,
-        'f1': f1
-    }
+    return _get_scores(true_positives, false_positives, false_negatives)
 
 
 def evaluate_argument_identification(labels, predictions, null_tag='_'):
@@ -100,17 +193,7 @@ def evaluate_argument_identification(labels, predictions, null_tag='_'):
                     elif r_g == null_tag and r_p != null_tag:
                         false_positives += 1
 
-    precision = true_positives / (true_positives + false_positives)
-    recall = true_positives / (true_positives + false_negatives)
-    f1 = 2 * (precision * recall) / (precision + recall)
-    return {
-        'true_positives': true_positives,
-        'false_positives': false_positives,
-        'false_negatives': false_negatives,
-        'precision': precision,
-        'recall': recall,
-        'f1': f1
-    }
+    return _get_scores(true_positives, false_positives, false_negatives)
 
 
 def evaluate_argument_classification(labels, predictions, null_tag='_'):
@@ -138,9 +221,165 @@ def evaluate_argument_classification(labels, predictions, null_tag='_'):
                     elif r_g == null_tag and r_p != null_tag:
                         false_positives += 1
                         
-    precision = true_positives / (true_positives + false_positives)
-    recall = true_positives / (true_positives + false_negatives)
-    f1 = 2 * (precision * recall) / (precision + recall)
+    return _get_scores(true_positives, false_positives, false_negatives)
+
+
+def compact_prediction(prediction, null_tag='_'):
+    """
+    Returns a copy of prediction where the roles of each predicate are a sparse {token index: role} dictionary
+    containing only the non-null roles, the inverse of expand_prediction.
+    """
+    compact = dict(prediction)
+    compact['roles'] = {
+        predicate_index: {i: role for i, role in enumerate(roles) if role != null_tag}
+        for predicate_index, roles in prediction['roles'].items()
+    }
+    return compact
+
+
+def expand_prediction(prediction, length, null_tag='_'):
+    """
+    Converts a prediction decoded from a server response back to the format returned by Model.predict, with integer
+    predicate indices and dense role lists of the given length. Both compact (see compact_prediction) and dense roles
+    are accepted.
+    """
+    roles = {}
+    for predicate_index, predicate_roles in prediction['roles'].items():
+        if isinstance(predicate_roles, dict):
+            dense_roles = [null_tag] * length
+            for i, role in predicate_roles.items():
+                dense_roles[int(i)] = role
+            predicate_roles = dense_roles
+        roles[int(predicate_index)] = predicate_roles
+    prediction['roles'] = roles
+    return prediction
+
+
+PREDICATE_TASKS = ('predicate_identification', 'predicate_disambiguation')
+ARGUMENT_TASKS = ('argument_identification', 'argument_classification')
+# the tasks scored for the model of each variant
+VARIANT_TASKS = {
+    '34': ARGUMENT_TASKS,
+    '234': ('predicate_disambiguation',) + ARGUMENT_TASKS,
+    '1234': PREDICATE_TASKS + ARGUMENT_TASKS,
+}
+
+
+def evaluate_all(labels, predictions, tasks=None, null_tag='_'):
+    """
+    Computes the scores of several tasks with a single pass over the sentences. The identification and the
+    classification of each level (predicates and roles) are counted together, on the same comparisons of the gold and
+    predicted tags.
+
+    Args:
+        labels: the gold labels, as returned by read_dataset.
+        predictions: the predictions, indexed by sentence id.
+        tasks: the tasks to evaluate, among PREDICATE_TASKS and ARGUMENT_TASKS. By default, the argument tasks are always
+            evaluated, while the predicate ones are evaluated only if every prediction contains predicates.
+
+    Returns:
+        A dictionary mapping each task to the same results returned by the corresponding evaluate_* function.
+    """
+    if tasks is None:
+        tasks = ARGUMENT_TASKS
+        if predictions and all('predicates' in prediction for prediction in predictions.values()):
+            tasks = PREDICATE_TASKS + ARGUMENT_TASKS
+
+    with_predicates = any(task in PREDICATE_TASKS for task in tasks)
+    predicate_counts, role_counts = [0] * 4, [0] * 4
+    for sentence_id, label in labels.items():
+        _count_sentence(label, predictions[sentence_id], with_predicates, null_tag, predicate_counts, role_counts)
+
+    counts = {}
+    if with_predicates:
+        counts['predicate_identification'], counts['predicate_disambiguation'] = _task_counts(np.array(predicate_counts)).tolist()
+    counts['argument_identification'], counts['argument_classification'] = _task_counts(np.array(role_counts)).tolist()
+
+    return {task: _get_scores(*counts[task]) for task in tasks}
+
+
+def count_per_sentence(labels, predictions, tasks, null_tag='_'):
+    """
+    Computes the (true positives, false positives, false negatives) counts of each sentence, so that the scores of
+    any subset (or resample) of the sentences can be computed by summing them.
+
+    Returns:
+        A pair (sentence_ids, counts), where counts maps each task to a (sentences, 3) numpy array whose rows follow
+        the order of sentence_ids.
+    """
+    with_predicates = any(task in PREDICATE_TASKS for task in tasks)
+    predicate_counts, role_counts = [], []
+    for sentence_id, label in labels.items():
+        predicate_counts.append([0] * 4)
+        role_counts.append([0] * 4)
+        _count_sentence(label, predictions[sentence_id], with_predicates, null_tag, predicate_counts[-1], role_counts[-1])
+
+    counts = {}
+    if with_predicates:
+        counts['predicate_identification'], counts['predicate_disambiguation'] = _task_counts(
+            np.array(predicate_counts, dtype=np.int64).reshape(-1, 4))
+    counts['argument_identification'], counts['argument_classification'] = _task_counts(
+        np.array(role_counts, dtype=np.int64).reshape(-1, 4))
+
+    return list(labels), {task: counts[task] for task in tasks}
+
+
+def _count_sentence(label, prediction, with_predicates, null_tag, predicate_counts, role_counts):
+    # roles of predicates that appear only in the gold (predicted) labels are compared with null predicted (gold) roles,
+    # so that they count as false negatives (positives) exactly as in evaluate_argument_*
+    if with_predicates:
+        _count_tags(label['predicates'], prediction['predicates'], null_tag, predicate_counts)
+
+    gold, pred = label['roles'], prediction['roles']
+    for idx, gold_idx_roles in gold.items():
+        if idx in pred:
+            _count_tags(gold_idx_roles, pred[idx], null_tag, role_counts)
+        else:
+            role_counts[3] += len(gold_idx_roles) - gold_idx_roles.count(null_tag)
+    for idx, pred_idx_roles in pred.items():
+        if idx not in gold:
+            role_counts[2] += len(pred_idx_roles) - pred_idx_roles.count(null_tag)
+
+
+def _count_tags(gold, pred, null_tag, counts):
+    """
+    Adds to counts the number of aligned gold and pred tags that are both non-null, that are both non-null and equal,
+    of non-null pred tags and of non-null gold tags.
+    """
+    if len(gold) != len(pred):
+        length = min(len(gold), len(pred))
+        gold, pred = gold[:length], pred[:length]
+
+    both_positive, equal = 0, 0
+    for g, p in zip(gold, pred):
+        if g != null_tag and p != null_tag:
+            both_positive += 1
+            if g == p:
+                equal += 1
+
+    counts[0] += both_positive
+    counts[1] += equal
+    counts[2] += len(pred) - pred.count(null_tag)
+    counts[3] += len(gold) - gold.count(null_tag)
+
+
+def _task_counts(counts):
+    """
+    Converts the counts of _count_tags (an array whose last axis has size 4) into the (true positives, false
+    positives, false negatives) counts of the identification and of the classification, with a new first axis.
+    """
+    both_positive, equal, pred_positive, gold_positive = np.moveaxis(counts, -1, 0)
+    # every predicted (gold) positive that is not a true positive is a false positive (negative)
+    return np.stack([
+        np.stack([both_positive, pred_positive - both_positive, gold_positive - both_positive], axis=-1),
+        np.stack([equal, pred_positive - equal, gold_positive - equal], axis=-1),
+    ])
+
+
+def _get_scores(true_positives, false_positives, false_negatives):
+    precision = true_positives / (true_positives + false_positives) if true_positives + false_positives else 0.0
+    recall = true_positives / (true_positives + false_negatives) if true_positives + false_negatives else 0.0
+    f1 = 2 * (precision * recall) / (precision + recall) if precision + recall else 0.0
     return {
         'true_positives': true_positives,
         'false_positives': false_positives,